@@ -1,19 +1,36 @@
 import os
 import sys
+import argparse
+import contextvars
+import threading
+import time
+import random
+import shutil
+import sqlite3
+import queue
 import requests
 from datetime import datetime, timedelta
 from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 import hashlib
-import smtplib
-from email.mime.text import MIMEText
-from pydrive2.auth import GoogleAuth
-from pydrive2.drive import GoogleDrive
+import io
+import json
+import fnmatch
+import mmap
+import logging
+import logging.handlers
+import tarfile
+import zlib
 from dotenv import load_dotenv
+# pydrive2/googleapiclient and smtplib are imported where they are used: most
+# runs end before Drive or email is needed, and the Google client stack alone
+# costs more startup time and memory than the rest of the script.
 
 # --- Load Environment Variables ---
 load_dotenv()
 
-# --- Ensure Required Environment Variables Are Set ---
+# --- Required Environment Variables (checked by init_runtime) ---
 REQUIRED_ENV_VARS = [
     "FLASHAIR_IP",
     "DOWNLOAD_DIR",
@@ -30,11 +47,11 @@ REQUIRED_ENV_VARS = [
     "LOG_DIR",
 ]
 
-missing_vars = [var for var in REQUIRED_ENV_VARS if not os.getenv(var)]
-if missing_vars:
-    missing_str = ", ".join(missing_vars)
-    sys.stderr.write(f"ERROR: Missing required environment variables: {missing_str}\n")
-    sys.exit(1)
+# With a profiles file, device and account settings may come from the profiles instead
+PROFILE_ENV_VARS = {
+    "FLASHAIR_IP", "DOWNLOAD_DIR", "CLIENT_ID", "CLIENT_SECRET", "USERNAME", "PASSWORD", "TEAM_ID",
+    "CREDENTIALS_JSON", "DRIVE_FOLDER_ID", "NOTIFICATION_EMAIL",
+}
 
 # --- Config ---
 
@@ -43,6 +60,21 @@ FLASHAIR_PASSWORD = os.getenv("FLASHAIR_PASSWORD")
 DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR")
 DAYS_TO_KEEP_FLASHAIR = int(os.getenv("DAYS_TO_KEEP_FLASHAIR", 7))
 DAYS_TO_KEEP_LOCAL = int(os.getenv("DAYS_TO_KEEP_LOCAL", 9))
+FLASHAIR_MAX_WORKERS = int(os.getenv("FLASHAIR_MAX_WORKERS", 3))
+FLASHAIR_RATE_LIMIT = int(os.getenv("FLASHAIR_RATE_LIMIT", 20))  # Requests per second to one card, 0 = unlimited
+FLASHAIR_FAILURE_THRESHOLD = int(os.getenv("FLASHAIR_FAILURE_THRESHOLD", 3))  # Consecutive failures that pause all requests
+FLASHAIR_OFFLINE_TIMEOUT = int(os.getenv("FLASHAIR_OFFLINE_TIMEOUT", 120))  # Seconds to wait for a silent card to return
+FLASHAIR_MAX_RETRIES = 3
+FLASHAIR_CONNECT_TIMEOUT = 3  # The card is on the LAN; a slow connect means it is gone
+FLASHAIR_TAIL_FETCH = os.getenv("FLASHAIR_TAIL_FETCH", "true").lower() in ("1", "true", "yes")
+EDF_HOLD_MAX_HOURS = int(os.getenv("EDF_HOLD_MAX_HOURS", 12))
+THERAPY_DAY_START_HOUR = 12  # ResMed counts a therapy night from noon to noon
+WATCH_POLL_INTERVAL = int(os.getenv("WATCH_POLL_INTERVAL", 60))
+WATCH_QUIET_PERIOD = int(os.getenv("WATCH_QUIET_PERIOD", 600))
+WATCH_RETRY_MAX = int(os.getenv("WATCH_RETRY_MAX", 3600))  # Longest wait before retrying a failed watch sync
+BACKFILL_MAX_PARALLEL = int(os.getenv("BACKFILL_MAX_PARALLEL", 2))
+CHUNK_SIZE = 64 * 1024  # Read/write size for streaming downloads, uploads and hashing
+UPLOAD_MEMORY_BUDGET_KB = int(os.getenv("UPLOAD_MEMORY_BUDGET_KB", 4096))  # Shared by all uploads in flight
 
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
@@ -50,9 +82,23 @@ USERNAME = os.getenv("USERNAME")
 PASSWORD = os.getenv("PASSWORD")
 TEAM_ID = os.getenv("TEAM_ID")
 BASE_API_URL = "https://sleephq.com/api/v1"
+OAUTH_TOKEN_URL = "https://sleephq.com/oauth/token"
+SLEEPHQ_MAX_WORKERS = int(os.getenv("SLEEPHQ_MAX_WORKERS", 4))
+SLEEPHQ_MAX_RETRIES = int(os.getenv("SLEEPHQ_MAX_RETRIES", 4))
+SLEEPHQ_TIMEOUT = 60
+SLEEPHQ_TOKEN_CACHE = os.getenv("SLEEPHQ_TOKEN_CACHE", "true").lower() == "true"
+SLEEPHQ_TOKEN_REFRESH_MARGIN = 300  # Refresh this many seconds before the access token expires
+SLEEPHQ_SKIP_UNCHANGED = os.getenv("SLEEPHQ_SKIP_UNCHANGED", "true").lower() == "true"
 
 CREDENTIALS_JSON = os.getenv("CREDENTIALS_JSON")
 DRIVE_FOLDER_ID = os.getenv("DRIVE_FOLDER_ID")
+DRIVE_MAX_WORKERS = int(os.getenv("DRIVE_MAX_WORKERS", 3))
+DRIVE_MAX_RETRIES = 3
+DRIVE_CHUNK_SIZE = 8 * 256 * 1024  # Resumable chunks must be a multiple of 256 KiB
+DRIVE_BATCH_SIZE = 100  # Most calls the Drive batch endpoint accepts in one request
+DRIVE_BACKUP_MODE = os.getenv("DRIVE_BACKUP_MODE", "files").lower()  # "files" or "archive"
+DRIVE_ARCHIVE_COMPRESSION = os.getenv("DRIVE_ARCHIVE_COMPRESSION", "gzip").lower()  # "gzip" or "zstd"
+DRIVE_PERSIST_FOLDER_CACHE = os.getenv("DRIVE_PERSIST_FOLDER_CACHE", "true").lower() == "true"
 
 SMTP_SERVER = "smtp.gmail.com"
 SMTP_PORT = 587
@@ -60,224 +106,1248 @@ GMAIL_USERNAME = os.getenv("GMAIL_USERNAME")
 GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD")
 NOTIFICATION_EMAIL = os.getenv("NOTIFICATION_EMAIL")
 
-LOG_DIR = os.getenv("LOG_DIR")
+PROFILES_FILE = os.getenv("PROFILES_FILE")
+PROFILE_MAX_PARALLEL = int(os.getenv("PROFILE_MAX_PARALLEL", 4))
+
+LOG_DIR = os.getenv("LOG_DIR", "")  # Checked by init_runtime(), so importing never fails
 SUCCESS_LOG = Path(LOG_DIR) / "success.log"
 ERROR_LOG = Path(LOG_DIR) / "errors.log"
-UPLOAD_LOG_FILE = Path(LOG_DIR) / "uploaded_hashes.log"
+UPLOAD_LOG_FILE = Path(LOG_DIR) / "uploaded_hashes.log"  # Legacy, migrated into DEDUP_DB_FILE
+DEDUP_DB_FILE = Path(LOG_DIR) / "dedup.sqlite3"
+HASH_RETENTION_DAYS = int(os.getenv("HASH_RETENTION_DAYS", 7))
+SYNC_MANIFEST_FILE = Path(LOG_DIR) / "sync_manifest.json"  # Legacy; now the dedup store's manifest table
+DRIVE_FOLDER_CACHE_FILE = Path(LOG_DIR) / "drive_folders.json"
+DRIVE_RESUME_STATE_FILE = Path(LOG_DIR) / "drive_resumable.json"
+SLEEPHQ_TOKEN_FILE = Path(LOG_DIR) / "sleephq_token.json"
+METRICS_JSON_FILE = Path(LOG_DIR) / "metrics.jsonl"
+METRICS_TEXTFILE = Path(os.getenv("METRICS_TEXTFILE") or Path(LOG_DIR) / "sleephq_uploader.prom")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 1_000_000))
+LOG_MAX_AGE_DAYS = int(os.getenv("LOG_MAX_AGE_DAYS", 7))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+LOG_BUFFER_RECORDS = 200
+LOG_FLUSH_INTERVAL = 30  # seconds a record may sit in the buffer before it is written
+REPORT_MAX_LINES = 500
+
+# --- Logging ---
+LEVEL_LABELS = {logging.INFO: "SUCCESS", logging.WARNING: "WARNING", logging.ERROR: "ERROR"}
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, run_id, stage, file, message."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(),
+            "level": LEVEL_LABELS.get(record.levelno, record.levelname),
+            "run_id": getattr(record, "run_id", None),
+            "profile": getattr(record, "profile", None),
+            "stage": getattr(record, "stage", None),
+            "file": getattr(record, "file", None),
+            "message": record.getMessage(),
+        }
+        return json.dumps({key: value for key, value in entry.items() if value is not None}, ensure_ascii=False)
+
+class SizeAndAgeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates when the file passes max_bytes or its first record is max_age seconds old.
+
+    Older generations are kept as name.1 ... name.<backup_count>.
+    """
+
+    def __init__(self, filename, max_bytes, max_age, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.max_age = max_age
+        self.first_record_at = self._first_record_time()
+
+    def _first_record_time(self):
+        """Timestamp of the file's first record, None if empty, 0 for a pre-JSON log (rotated at once)."""
+        try:
+            with open(self.baseFilename, encoding="utf-8") as f:
+                first_line = f.readline()
+        except OSError:
+            return None
+        if not first_line:
+            return None
+        try:
+            return datetime.fromisoformat(json.loads(first_line)["ts"]).timestamp()
+        except (ValueError, KeyError, TypeError):
+            return 0
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.first_record_at is None:
+            self.first_record_at = record.created
+            return False
+        return record.created - self.first_record_at >= self.max_age
+
+    def doRollover(self):
+        super().doRollover()
+        self.first_record_at = None
+
+class BufferedLogHandler(logging.handlers.MemoryHandler):
+    """Holds records in memory and writes them in batches.
 
-os.makedirs(LOG_DIR, exist_ok=True)
+    Flushes when the buffer is full, when its oldest record is flush_interval
+    seconds old, on flush_logs() at the end of each run, and at exit.
+    """
 
-# --- Log Rotation ---
-def rotate_log(log_path, max_bytes=1_000_000):
-    if os.path.exists(log_path) and os.path.getsize(log_path) > max_bytes:
-        with open(log_path, "w") as f:
-            f.write("")  # Truncate
+    def __init__(self, target, capacity, flush_interval):
+        super().__init__(capacity, flushLevel=logging.CRITICAL, target=target)
+        self.flush_interval = flush_interval
 
-rotate_log(SUCCESS_LOG)
-rotate_log(ERROR_LOG)
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or record.created - self.buffer[0].created >= self.flush_interval
+
+class RunReport(logging.Handler):
+    """In-memory summary of one run's log events, used for the email reports."""
+
+    def __init__(self, max_lines=REPORT_MAX_LINES):
+        super().__init__()
+        self.max_lines = max_lines
+        self.lines = {"SUCCESS": [], "WARNING": [], "ERROR": []}
+        self.counts = {"SUCCESS": 0, "WARNING": 0, "ERROR": 0}
+
+    def emit(self, record):
+        label = LEVEL_LABELS.get(record.levelno, "ERROR")
+        self.counts[label] += 1
+        if len(self.lines[label]) < self.max_lines:
+            line = f"{datetime.fromtimestamp(record.created)} - {label}"
+            if getattr(record, "stage", None):
+                line += f" [{record.stage}]"
+            self.lines[label].append(f"{line}: {record.getMessage()}")
+
+    def text(self, label):
+        """This run's lines for label ("SUCCESS", "WARNING" or "ERROR"), capped at max_lines."""
+        self.acquire()
+        try:
+            lines = list(self.lines[label])
+            omitted = self.counts[label] - len(lines)
+        finally:
+            self.release()
+        if omitted:
+            lines.append(f"... and {omitted} more")
+        return "\n".join(lines)
+
+class RunReportRouter(logging.Handler):
+    """Hands each record to the RunReport of the run that logged it, if any."""
+
+    def emit(self, record):
+        report = getattr(record, "report", None)
+        if report is not None:
+            report.handle(record)
+
+LOGGER = logging.getLogger("sleephq_uploader")
+LOGGER.addHandler(logging.NullHandler())  # Console output only until setup_logging() runs
+
+def setup_logging():
+    """Route log_success/log_warning to SUCCESS_LOG, log_error to ERROR_LOG (buffered, rotated) and run reports."""
+    if any(isinstance(handler, RunReportRouter) for handler in LOGGER.handlers):
+        return  # Already set up
+    LOGGER.setLevel(logging.INFO)
+    LOGGER.propagate = False
+    formatter = JsonLogFormatter()
+    for log_file, keep in [(SUCCESS_LOG, lambda record: record.levelno < logging.ERROR),
+                           (ERROR_LOG, lambda record: record.levelno >= logging.ERROR)]:
+        file_handler = SizeAndAgeRotatingFileHandler(log_file, LOG_MAX_BYTES, LOG_MAX_AGE_DAYS * 86400,
+                                                     LOG_BACKUP_COUNT)
+        file_handler.setFormatter(formatter)
+        buffered = BufferedLogHandler(file_handler, LOG_BUFFER_RECORDS, LOG_FLUSH_INTERVAL)
+        buffered.addFilter(keep)
+        LOGGER.addHandler(buffered)
+    LOGGER.addHandler(RunReportRouter())
+
+def flush_logs():
+    for handler in LOGGER.handlers:
+        handler.flush()
+
+# --- Run Context ---
+# The run (and profile) a thread is working for. Logging and metrics read it so
+# that concurrent profile runs keep separate reports, metrics and log tags.
+# Worker threads inherit it through in_current_context().
+CURRENT_RUN = contextvars.ContextVar("current_run", default=None)
+
+def in_current_context(fn):
+    """Wrap fn so it runs in a copy of the caller's context, e.g. on a worker thread."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+def _log_extra(step, file):
+    run = CURRENT_RUN.get()
+    if run is None:
+        return {"run_id": None, "profile": None, "report": None, "stage": step, "file": file}
+    return {"run_id": run.run_id, "profile": run.profile_name, "report": run.report, "stage": step, "file": file}
 
 # --- Logging Helpers ---
-def log_success(message, step=None):
+def log_success(message, step=None, file=None):
     entry = f"{datetime.now()} - SUCCESS"
     if step:
         entry += f" [{step}]"
-    entry += f": {message}\n"
-    with open(SUCCESS_LOG, "a") as f:
-        f.write(entry)
-    print(f"✅ {entry.strip()}")
+    entry += f": {message}"
+    LOGGER.info(message, extra=_log_extra(step, file))
+    print(f"✅ {entry}")
+
+def log_warning(message, step=None, file=None):
+    """A problem that was handled (e.g. a retried request): logged, but not an error in the run report."""
+    entry = f"{datetime.now()} - WARNING"
+    if step:
+        entry += f" [{step}]"
+    entry += f": {message}"
+    LOGGER.warning(message, extra=_log_extra(step, file))
+    print(f"⚠️ {entry}")
 
-def log_error(message, step=None):
+def log_error(message, step=None, file=None):
     entry = f"{datetime.now()} - ERROR"
     if step:
         entry += f" [{step}]"
-    entry += f": {message}\n"
-    with open(ERROR_LOG, "a") as f:
-        f.write(entry)
-    print(f"❌ {entry.strip()}")
-
-# --- FlashAir Helpers ---
-def flashair_get(params):
-    p = params.copy()
-    if FLASHAIR_PASSWORD:
-        p["p"] = FLASHAIR_PASSWORD
-    r = requests.get(f"http://{FLASHAIR_IP}/command.cgi", params=p, timeout=10)
-    r.raise_for_status()
-    return r.text
-
-def list_flashair_files(root="/"):
-    stack = [root]
-    all_files = []
-    while stack:
-        current_dir = stack.pop()
+    entry += f": {message}"
+    LOGGER.error(message, extra=_log_extra(step, file))
+    print(f"❌ {entry}")
+
+# --- Run Metrics ---
+class RunMetrics:
+    """Per-run timing spans for each stage, with bytes, retry counts and error classes.
+
+    Stage totals are written at the end of a run as a JSON line (for history)
+    and as a Prometheus textfile-collector file (for graphing/alerting).
+    """
+
+    def __init__(self, run_id=None, profile_name="default"):
+        self.lock = threading.Lock()
+        self.run_id = run_id
+        self.profile_name = profile_name
+        self.run_started = time.time()
+        self.stages = {}
+
+    @contextmanager
+    def span(self, stage, nbytes=0):
+        """Time a block. The yielded dict accepts "bytes", "retries" and "error" updates."""
+        span = {"bytes": nbytes, "retries": 0, "error": None}
+        start = time.perf_counter()
         try:
-            data = flashair_get({"op": "100", "DIR": current_dir})
+            yield span
         except Exception as e:
-            log_error(f"Failed to list {current_dir}: {e}")
-            continue
-        lines = data.splitlines()
-        if not lines or lines[0] != "WLANSD_FILELIST":
-            continue
-        for line in lines[1:]:
-            parts = line.split(",")
-            if len(parts) < 4:
-                continue
-            name = parts[1].strip()
-            attribute = parts[3].strip()
-            full_path = current_dir.rstrip("/") + "/" + name
-            if attribute == "16":
-                stack.append(full_path)
-            else:
-                all_files.append(full_path)
-    return all_files
+            span["error"] = type(e).__name__
+            raise
+        finally:
+            self._record(stage, time.perf_counter() - start, span)
 
+    def _record(self, stage, seconds, span):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {
+                "count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0, "retries": 0, "errors": {},
+            })
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["bytes"] += span["bytes"]
+            stats["retries"] += span["retries"]
+            if span["error"]:
+                stats["errors"][span["error"]] = stats["errors"].get(span["error"], 0) + 1
 
-def list_flashair_dirs(root="/"):
-    """Return a list of directories directly under the given root path."""
-    try:
-        data = flashair_get({"op": "100", "DIR": root})
-    except Exception as e:
-        log_error(f"Failed to list {root}: {e}")
-        return []
+    def summary(self, exit_code=None):
+        with self.lock:
+            return {
+                "run_id": self.run_id,
+                "profile": self.profile_name,
+                "started_at": datetime.fromtimestamp(self.run_started).isoformat(timespec="seconds"),
+                "duration_seconds": round(time.time() - self.run_started, 3),
+                "exit_code": exit_code,
+                "stages": {
+                    stage: dict(stats, seconds=round(stats["seconds"], 3), max_seconds=round(stats["max_seconds"], 3),
+                                errors=dict(stats["errors"]))
+                    for stage, stats in sorted(self.stages.items())
+                },
+            }
+
+    def emit(self, exit_code, json_file, prom_file):
+        """Append the run summary to json_file (JSON lines) and rewrite prom_file."""
+        summary = self.summary(exit_code)
+        with open(json_file, "a") as f:
+            f.write(json.dumps(summary) + "\n")
+        prefix = "sleephq_uploader"
+        profile = f'profile="{self.profile_name}"'
+        lines = [
+            f"# HELP {prefix}_last_run_timestamp_seconds Start time of the last run.",
+            f"# TYPE {prefix}_last_run_timestamp_seconds gauge",
+            f"{prefix}_last_run_timestamp_seconds{{{profile}}} {self.run_started:.0f}",
+            f"# HELP {prefix}_run_duration_seconds Wall time of the last run.",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds{{{profile}}} {summary['duration_seconds']}",
+            f"# HELP {prefix}_run_exit_code Exit code of the last run.",
+            f"# TYPE {prefix}_run_exit_code gauge",
+            f"{prefix}_run_exit_code{{{profile}}} {exit_code}",
+        ]
+        for field, help_text in [
+            ("count", "Spans recorded per stage in the last run."),
+            ("seconds", "Total time spent per stage in the last run."),
+            ("max_seconds", "Slowest single span per stage in the last run."),
+            ("bytes", "Bytes transferred per stage in the last run."),
+            ("retries", "Retries per stage in the last run."),
+        ]:
+            lines.append(f"# HELP {prefix}_stage_{field} {help_text}")
+            lines.append(f"# TYPE {prefix}_stage_{field} gauge")
+            for stage, stats in summary["stages"].items():
+                lines.append(f'{prefix}_stage_{field}{{{profile},stage="{stage}"}} {stats[field]}')
+        lines.append(f"# HELP {prefix}_stage_errors Failed spans per stage and error class in the last run.")
+        lines.append(f"# TYPE {prefix}_stage_errors gauge")
+        for stage, stats in summary["stages"].items():
+            for error, count in stats["errors"].items():
+                lines.append(f'{prefix}_stage_errors{{{profile},stage="{stage}",error="{error}"}} {count}')
+        # Write then rename so the node exporter never reads a half-written file
+        tmp_file = prom_file.with_name(prom_file.name + ".tmp")
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, prom_file)
+        return summary
+
+METRICS = RunMetrics()  # Collects spans recorded outside any run
+
+def current_metrics():
+    run = CURRENT_RUN.get()
+    return run.metrics if run is not None else METRICS
+
+class RunContext:
+    """One sync run: its ID, profile, metrics and email report."""
 
+    def __init__(self, profile_name):
+        self.run_id = f"{datetime.now():%Y%m%dT%H%M%S}-{os.urandom(3).hex()}"
+        self.profile_name = profile_name
+        self.metrics = RunMetrics(self.run_id, profile_name)
+        self.report = RunReport()
+        self.incomplete_files = []  # Files of sessions still being written, left for a later run
+
+# --- FlashAir Client ---
+def parse_flashair_listing(data, current_dir):
+    """Parse an op=100 listing into entries with size and FAT date/time fields."""
     lines = data.splitlines()
     if not lines or lines[0] != "WLANSD_FILELIST":
         return []
-
-    dirs = []
+    entries = []
     for line in lines[1:]:
+        # Format: <directory>,<filename>,<size>,<attribute>,<date>,<time>
         parts = line.split(",")
         if len(parts) < 4:
             continue
         name = parts[1].strip()
         attribute = parts[3].strip()
-        if attribute == "16":
-            dirs.append(root.rstrip("/") + "/" + name)
+        try:
+            size = int(parts[2])
+            date = int(parts[4]) if len(parts) > 4 else 0
+            time = int(parts[5]) if len(parts) > 5 else 0
+        except ValueError:
+            size, date, time = -1, 0, 0
+        entries.append({
+            "path": current_dir.rstrip("/") + "/" + name,
+            "size": size,
+            "date": date,
+            "time": time,
+            "is_dir": attribute == "16",
+        })
+    return entries
 
-    return dirs
+class AdaptiveLimiter:
+    """Concurrency cap that halves on failures and grows by one after a run of successes."""
 
-def flashair_download_file(remote_path, local_path):
-    try:
+    def __init__(self, maximum, minimum=1, ramp_after=8):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = max(self.minimum, min(2, self.maximum))
+        self.ramp_after = ramp_after
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, ok=True):
+        """Release a slot. ok=False backs off, ok=None leaves the limit alone."""
+        with self._cond:
+            self.in_flight -= 1
+            if ok is False:
+                self._successes = 0
+                self.limit = max(self.minimum, self.limit // 2)
+            elif ok:
+                self._successes += 1
+                if self._successes >= self.ramp_after and self.limit < self.maximum:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+class TokenBucket:
+    """Rate limiter: take() blocks until one of rate-per-second tokens is free; 0 means unlimited."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_s = (1 - self.tokens) / self.rate
+            time.sleep(wait_s)
+
+
+class FlashAirUnavailable(Exception):
+    """The card stopped answering and did not come back within FLASHAIR_OFFLINE_TIMEOUT."""
+
+
+def is_card_failure(error):
+    """Timeouts, dropped connections and 5xx mean the card is struggling; a 4xx is just a bad request."""
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+class FlashAirHealth:
+    """Circuit breaker shared by every request to one card.
+
+    After FLASHAIR_FAILURE_THRESHOLD consecutive failures the circuit opens:
+    requests stop going out and wait while one caller probes the card with
+    backoff. The first probe that answers closes it again and the waiting
+    requests carry on. If the card stays silent for FLASHAIR_OFFLINE_TIMEOUT
+    the monitor gives up and requests fail at once with FlashAirUnavailable,
+    apart from one probe every 30 s so a later run (or watch cycle) finds
+    the card again. outages counts those give-ups.
+    """
+
+    def __init__(self, probe, threshold=None, offline_timeout=None):
+        self.probe = probe
+        self.threshold = threshold or FLASHAIR_FAILURE_THRESHOLD
+        self.offline_timeout = offline_timeout if offline_timeout is not None else FLASHAIR_OFFLINE_TIMEOUT
+        self.failures = 0
+        self.opened_at = None  # Set while the circuit is open
+        self.gave_up = False
+        self.next_probe = 0
+        self.outages = 0
+        self._probing = False
+        self._cond = threading.Condition()
+
+    def record_success(self):
+        with self._cond:
+            self.failures = 0
+
+    def record_failure(self):
+        with self._cond:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                log_warning(f"FlashAir failed {self.failures} requests in a row; pausing requests until it answers again",
+                            step="FlashAir")
+
+    def wait_until_available(self):
+        """Return once requests may go to the card; raises FlashAirUnavailable after giving up on it."""
+        with self._cond:
+            while True:
+                if self.opened_at is None:
+                    return
+                if self.gave_up and time.monotonic() < self.next_probe:
+                    raise FlashAirUnavailable(f"FlashAir has not answered for {self.offline_timeout}s")
+                if not self._probing:
+                    self._probing = True
+                    break
+                self._cond.wait()
+        try:
+            self._probe_until_back()
+        finally:
+            with self._cond:
+                self._probing = False
+                self._cond.notify_all()
+
+    def _probe_until_back(self):
+        with current_metrics().span("flashair_offline") as span:
+            attempt = 0
+            while True:
+                if self.probe():
+                    with self._cond:
+                        log_success(f"FlashAir is answering again after {time.monotonic() - self.opened_at:.1f}s",
+                                    step="FlashAir")
+                        self.opened_at = None
+                        self.failures = 0
+                        self.gave_up = False
+                    return
+                remaining = self.opened_at + self.offline_timeout - time.monotonic()
+                if self.gave_up or remaining <= 0:
+                    with self._cond:
+                        if not self.gave_up:
+                            self.gave_up = True
+                            self.outages += 1
+                            span["error"] = "FlashAirUnavailable"
+                            log_error(f"FlashAir has not answered for {self.offline_timeout}s, giving up on it",
+                                      step="FlashAir")
+                        self.next_probe = time.monotonic() + 30
+                    raise FlashAirUnavailable(f"FlashAir has not answered for {self.offline_timeout}s")
+                span["retries"] += 1
+                time.sleep(min(backoff_delay(attempt, cap=5.0), remaining))
+                attempt += 1
+
+
+class FlashAirClient:
+    """Keep-alive session and small worker pool for all FlashAir traffic.
+
+    Every request passes a TokenBucket and a FlashAirHealth circuit breaker,
+    then takes a slot from an AdaptiveLimiter, so the number of requests in
+    flight shrinks when the card times out or returns 5xx errors and grows
+    again while it keeps up. Card failures are retried with backoff.
+    """
+
+    def __init__(self, ip=None, password=None, max_workers=None):
+        self.ip = ip or FLASHAIR_IP
+        self.password = password if password is not None else FLASHAIR_PASSWORD
+        max_workers = max_workers or FLASHAIR_MAX_WORKERS
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.limiter = AdaptiveLimiter(max_workers)
+        self.bucket = TokenBucket(FLASHAIR_RATE_LIMIT)
+        self.health = FlashAirHealth(self._probe)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="flashair")
+        self.range_supported = None  # Learned from the first Range request
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    @contextmanager
+    def _slot(self):
+        self.limiter.acquire()
+        ok = False
+        try:
+            yield
+            ok = True
+        except requests.HTTPError as e:
+            # 4xx means a bad path, not an overloaded card
+            status = e.response.status_code if e.response is not None else 500
+            ok = None if status < 500 else False
+            raise
+        finally:
+            self.limiter.release(ok)
+
+    def _request(self, send, description, span=None):
+        """Call send() (one FlashAir operation) behind the rate limiter, circuit breaker and adaptive limiter.
+
+        Card failures are retried with backoff and counted on span when one is given.
+        """
+        for attempt in range(FLASHAIR_MAX_RETRIES + 1):
+            self.health.wait_until_available()
+            self.bucket.take()
+            try:
+                with self._slot():
+                    result = send()
+            except Exception as e:
+                if not is_card_failure(e):
+                    raise
+                self.health.record_failure()
+                if attempt == FLASHAIR_MAX_RETRIES:
+                    raise  # The caller logs the final failure
+                delay = backoff_delay(attempt, base=0.5, cap=5.0)
+                log_warning(f"{description} failed ({e}), retrying in {delay:.1f}s")
+                if span is not None:
+                    span["retries"] += 1
+                time.sleep(delay)
+            else:
+                self.health.record_success()
+                return result
+
+    def _probe(self):
+        """Cheap liveness check (op=108, firmware version) that bypasses the breaker and limiters."""
+        params = {"op": "108"}
+        if self.password:
+            params["p"] = self.password
+        try:
+            return self.session.get(f"http://{self.ip}/command.cgi", params=params, timeout=FLASHAIR_CONNECT_TIMEOUT).ok
+        except requests.RequestException:
+            return False
+
+    def get(self, params):
+        p = params.copy()
+        if self.password:
+            p["p"] = self.password
+
+        def send():
+            r = self.session.get(f"http://{self.ip}/command.cgi", params=p, timeout=(FLASHAIR_CONNECT_TIMEOUT, 10))
+            r.raise_for_status()
+            return r.text
+        return self._request(send, f"FlashAir command op={params['op']}")
+
+    def list_dir(self, current_dir):
+        """List one directory; errors propagate to the caller."""
+        return parse_flashair_listing(self.get({"op": "100", "DIR": current_dir}), current_dir)
+
+    def _list_dir(self, current_dir):
+        try:
+            return self.list_dir(current_dir)
+        except Exception as e:
+            if not isinstance(e, FlashAirUnavailable):
+                log_error(f"Failed to list {current_dir}: {e}")
+            return []
+
+    def list_entries(self, roots="/", recursive=True):
+        """Return listing entries (path, size, date, time) for files under one or more roots.
+
+        Subdirectories are listed in parallel on the worker pool.
+        """
+        if isinstance(roots, str):
+            roots = [roots]
+        all_entries = []
+        with current_metrics().span("flashair_list"):
+            pending = {self.executor.submit(in_current_context(self._list_dir), root) for root in roots}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for entry in future.result():
+                        if not entry["is_dir"]:
+                            all_entries.append(entry)
+                        elif recursive:
+                            pending.add(self.executor.submit(in_current_context(self._list_dir), entry["path"]))
+        return sorted(all_entries, key=lambda entry: entry["path"])
+
+    def list_dirs(self, root="/"):
+        """Return a list of directories directly under the given root path."""
+        return [entry["path"] for entry in self._list_dir(root) if entry["is_dir"]]
+
+    def _file_url(self, remote_path):
         url_path = remote_path.replace("/", "%2F").lstrip("/")
-        download_url = f"http://{FLASHAIR_IP}/{url_path}"
-        if FLASHAIR_PASSWORD:
-            download_url += f"?p={FLASHAIR_PASSWORD}"
-        response = requests.get(download_url, timeout=30)
+        download_url = f"http://{self.ip}/{url_path}"
+        if self.password:
+            download_url += f"?p={self.password}"
+        return download_url
+
+    @staticmethod
+    def _stream(response, f, digest, span):
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            digest.update(chunk)
+            f.write(chunk)
+            span["bytes"] += len(chunk)
+
+    def _range_get(self, url, start, end=""):
+        """Ranged GET; returns None (and stops trying Range) if the card sends the whole file."""
+        response = self.session.get(url, headers={"Range": f"bytes={start}-{end}"},
+                                    timeout=(FLASHAIR_CONNECT_TIMEOUT, 30), stream=True)
         response.raise_for_status()
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        with open(local_path, "wb") as f:
-            f.write(response.content)
-        log_success(f"Downloaded file: {remote_path} to {local_path}")
-    except Exception as e:
-        log_error(f"Failed to download file: {remote_path} - {e}")
+        if response.status_code != 206:
+            response.close()
+            self.range_supported = False
+            log_success("FlashAir ignores HTTP Range; growing files will be fetched in full")
+            return None
+        self.range_supported = True
+        return response
 
-def flashair_delete_file(remote_path):
-    try:
-        flashair_get({"op": "111", "DEL": remote_path})
-        log_success(f"Deleted file from FlashAir: {remote_path}")
-    except Exception as e:
-        log_error(f"Failed to delete file from FlashAir: {remote_path} - {e}")
+    def _download_tail(self, url, f, digest, span, local_path, held_size, header_size):
+        """Rebuild a grown file from the card's header, our held prefix and the card's new tail.
 
-def cleanup_local_files(base_dir, days_old):
-    cutoff = datetime.now() - timedelta(days=days_old)
-    for dirpath, dirnames, filenames in os.walk(base_dir):
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
+        The last few KiB of the held prefix are fetched again and compared, so a
+        file that was rewritten rather than appended to is caught. Returns False
+        when that check fails or Range isn't supported.
+        """
+        overlap = min(held_size - header_size, 4096)
+        header = b""
+        if header_size:
+            response = self._range_get(url, 0, header_size - 1)
+            if response is None:
+                return False
+            with response:
+                header = response.content
+            if len(header) != header_size:
+                return False
+        response = self._range_get(url, held_size - overlap)
+        if response is None:
+            return False
+        with response, open(local_path, "rb") as held:
+            tail = response.iter_content(chunk_size=CHUNK_SIZE)
+            seen = b""
+            while len(seen) < overlap:
+                chunk = next(tail, b"")
+                if not chunk:
+                    return False
+                seen += chunk
+            held.seek(held_size - overlap)
+            if seen[:overlap] != held.read(overlap):
+                return False
+            span["bytes"] += header_size + len(seen)
+            # Header from the card, then the unchanged middle from the held copy
+            digest.update(header)
+            f.write(header)
+            held.seek(header_size)
+            remaining = held_size - header_size
+            while remaining:
+                chunk = held.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return False
+                digest.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+            rest = seen[overlap:]
+            digest.update(rest)
+            f.write(rest)
+            for chunk in tail:
+                digest.update(chunk)
+                f.write(chunk)
+                span["bytes"] += len(chunk)
+        return True
+
+    def _fetch(self, url, tmp_path, local_path, held_size, header_size, span):
+        """One download attempt into tmp_path; returns (sha256 hash object, whether only the tail was fetched)."""
+        with open(tmp_path, "wb") as f:
+            sha256_hash = hashlib.sha256()
+            tail_fetched = bool(held_size) and self.range_supported is not False and self._download_tail(
+                url, f, sha256_hash, span, local_path, held_size, header_size)
+            if not tail_fetched:
+                f.seek(0)
+                f.truncate()
+                sha256_hash = hashlib.sha256()
+                with self.session.get(url, timeout=(FLASHAIR_CONNECT_TIMEOUT, 30), stream=True) as response:
+                    response.raise_for_status()
+                    self._stream(response, f, sha256_hash, span)
+        return sha256_hash, tail_fetched
+
+    def download(self, remote_path, local_path, held_size=0, header_size=0):
+        """Stream a file to disk, hashing it as it arrives.
+
+        Chunks are written to a ``.part`` file that is renamed into place once the
+        download completes, so an interrupted transfer never leaves a truncated
+        file behind. Returns the SHA-256 hex digest, or None on failure.
+
+        held_size > 0 means local_path already holds the file's first held_size
+        bytes (checked by the caller) and the card's copy has only grown. Then
+        just its header_size-byte header (an EDF header is rewritten as records
+        are added) and the new tail are fetched with HTTP Range, falling back
+        to a full download when the card doesn't support Range.
+        """
+        tmp_path = Path(str(local_path) + ".part")
+        with current_metrics().span("flashair_download") as span:
             try:
-                mtime = datetime.fromtimestamp(os.path.getmtime(filepath))
-                if mtime < cutoff:
-                    os.remove(filepath)
-                    log_success(f"Deleted local file: {filepath}")
+                download_url = self._file_url(remote_path)
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                sha256_hash, tail_fetched = self._request(
+                    lambda: self._fetch(download_url, tmp_path, local_path, held_size, header_size, span),
+                    f"Download of {remote_path}", span)
+                os.replace(tmp_path, local_path)
+                if tail_fetched:
+                    log_success(f"Fetched new tail of grown file: {remote_path} ({span['bytes']} bytes transferred)",
+                                file=remote_path)
+                else:
+                    log_success(f"Downloaded file: {remote_path} to {local_path}", file=remote_path)
+                return sha256_hash.hexdigest()
             except Exception as e:
-                log_error(f"Failed to delete local file: {filepath} - {e}")
-
-# --- FlashAir Cleanup Helper ---
-def cleanup_flashair_dated_folders(base_dir, days_old):
-    cutoff_date = datetime.now() - timedelta(days=days_old)
-    directories = list_flashair_dirs(base_dir)
-    for directory in directories:
-        folder_name = directory.strip("/").split("/")[-1]
+                span["error"] = type(e).__name__
+                if not isinstance(e, FlashAirUnavailable):  # FlashAirHealth already logged the outage once
+                    log_error(f"Failed to download file: {remote_path} - {e}", file=remote_path)
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                return None
+
+    def download_many(self, items):
+        """Download (remote_path, local_path[, held_size, header_size]) items on the worker pool.
+
+        Yields (remote_path, local_path, sha256 or None) as each download finishes.
+        """
+        futures = {
+            self.executor.submit(in_current_context(self.download), *item): (item[0], item[1])
+            for item in items
+        }
+        for future in as_completed(futures):
+            remote_path, local_path = futures[future]
+            yield remote_path, local_path, future.result()
+
+    def delete(self, remote_path):
         try:
-            folder_date = datetime.strptime(folder_name, "%Y%m%d")
-        except ValueError:
-            continue
-        if folder_date < cutoff_date:
-            flashair_delete_file(directory)
-            log_success(f"Deleted old folder from FlashAir: {directory}")
+            self.get({"op": "111", "DEL": remote_path})
+            log_success(f"Deleted file from FlashAir: {remote_path}")
+            return True
+        except Exception as e:
+            if not isinstance(e, FlashAirUnavailable):
+                log_error(f"Failed to delete file from FlashAir: {remote_path} - {e}")
+            return False
+
+    def delete_many(self, remote_paths):
+        """Delete paths on the worker pool (the adaptive limiter still caps load on the card); returns those deleted."""
+        futures = {self.executor.submit(in_current_context(self.delete), path): path for path in remote_paths}
+        return [futures[future] for future in as_completed(futures) if future.result()]
 
-# --- SleepHQ Helpers ---
-def get_access_token():
+# --- State File Helpers ---
+def load_json_state(state_file):
+    """Load a small JSON state file (caches, resumable uploads); missing or corrupt means empty."""
+    if not state_file or not state_file.exists():
+        return {}
     try:
-        url = "https://sleephq.com/oauth/token"
-        data = {
-            "grant_type": "password",
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "username": USERNAME,
-            "password": PASSWORD,
-            "scope": "read write"
-        }
-        headers = {"accept": "application/json"}
-        response = requests.post(url, data=data, headers=headers)
-        response.raise_for_status()
-        log_success("Authenticated with SleepHQ")
-        return response.json()["access_token"]
+        with open(state_file, "r") as f:
+            return json.load(f)
     except Exception as e:
-        log_error(f"Failed to authenticate with SleepHQ: {e}")
-        raise
+        log_error(f"Failed to read {state_file}, starting fresh: {e}")
+        return {}
+
+def save_json_state(state, state_file, private=False):
+    """Write a JSON state file atomically via a temp file and rename; private files are owner-only (0600)."""
+    tmp_file = state_file.with_name(state_file.name + ".tmp")
+    if private:
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # In case a stale temp file had wider permissions
+        f = os.fdopen(fd, "w")
+    else:
+        f = open(tmp_file, "w")
+    with f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+def is_unchanged_on_flashair(entry, known, local_path):
+    """True when the listing entry matches the file as last downloaded (known) and the local copy is intact."""
+    if entry is None or not known:
+        return False
+    if (known["size"], known["date"], known["time"]) != (entry["size"], entry["date"], entry["time"]):
+        return False
+    return local_path.exists() and local_path.stat().st_size == entry["size"]
 
-def create_import(access_token):
+# --- EDF Helpers ---
+def fat_datetime(fat_date, fat_time):
+    """Decode FlashAir listing FAT date/time fields; None if they're not a valid timestamp."""
     try:
-        url = f"{BASE_API_URL}/teams/{TEAM_ID}/imports"
-        data = {"programatic": False}
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "accept": "application/vnd.api+json",
-            "Content-Type": "application/json"
-        }
-        response = requests.post(url, json=data, headers=headers)
-        response.raise_for_status()
-        import_id = response.json()["data"]["id"]
-        log_success(f"Created Import ID: {import_id}")
-        return import_id
-    except Exception as e:
-        log_error(f"Failed to create import: {e}")
-        raise
+        return datetime(1980 + (fat_date >> 9), (fat_date >> 5) & 0x0F, fat_date & 0x1F,
+                        fat_time >> 11, (fat_time >> 5) & 0x3F, (fat_time & 0x1F) * 2)
+    except ValueError:
+        return None
 
-def upload_file_to_import(file_path, access_token, import_id, relative_path):
+def edf_start(start_date, start_time):
+    """Recording start from the EDF "dd.mm.yy" and "hh.mm.ss" fields (years 85-99 are 19xx); None if invalid."""
     try:
-        url = f"{BASE_API_URL}/imports/{import_id}/files"
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "accept": "application/vnd.api+json"
-        }
-        content_hash = sha256_of_file(file_path)
-        with open(file_path, "rb") as f:
-            files = {"file": (file_path.name, f)}
-            data = {
-                "name": file_path.name,
-                "path": str(relative_path),
-                "content_hash": content_hash
-            }
-            response = requests.post(url, headers=headers, data=data, files=files)
-            response.raise_for_status()
-            log_success(f"Uploaded file to SleepHQ: {file_path}")
-            return True
-    except Exception as e:
-        log_error(f"Failed to upload file to SleepHQ: {file_path} - {e}")
-        return False
+        day, month, year = (int(part) for part in start_date.split(b"."))
+        hour, minute, second = (int(part) for part in start_time.split(b"."))
+        return datetime(year + (1900 if year >= 85 else 2000), month, day, hour, minute, second)
+    except ValueError:
+        return None
+
+def edf_header(path):
+    """Parse the fixed header and signal headers of an EDF file through mmap; None if it isn't one.
 
-def process_import(access_token, import_id):
+    Only the header pages are touched, however large the file. Returns the
+    header size, record count (-1 while unset), data record size and length,
+    recording start, duration and signal labels.
+    """
     try:
-        url = f"{BASE_API_URL}/imports/{import_id}/process_files"
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "accept": "application/vnd.api+json"
-        }
-        response = requests.post(url, headers=headers)
-        response.raise_for_status()
-        log_success(f"Processed Import ID: {import_id}")
-    except Exception as e:
-        log_error(f"Failed to process import: {import_id} - {e}")
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            header_bytes = int(m[184:192])
+            n_records = int(m[236:244])
+            record_seconds = float(m[244:252])
+            n_signals = int(m[252:256])
+            if header_bytes != 256 * (n_signals + 1) or len(m) < header_bytes:
+                return None
+            signals = [m[256 + i * 16:256 + (i + 1) * 16].decode("ascii", "replace").strip() for i in range(n_signals)]
+            # Per-signal "samples in each data record" fields follow seven other per-signal fields
+            samples = 256 + n_signals * 216
+            record_bytes = 2 * sum(int(m[samples + i * 8:samples + (i + 1) * 8]) for i in range(n_signals))
+            start = edf_start(m[168:176], m[176:184])
+    except (OSError, ValueError):
+        return None  # mmap raises ValueError for an empty file
+    return {
+        "header_bytes": header_bytes,
+        "n_records": n_records,
+        "record_bytes": record_bytes,
+        "record_seconds": record_seconds,
+        "start": start.isoformat() if start else None,
+        "duration": n_records * record_seconds if n_records >= 0 else None,
+        "signals": signals,
+    }
+
+def edf_is_incomplete(path, header=None):
+    """True while an EDF file is still being written: record count unset (-1) or records missing."""
+    header = header or edf_header(path)
+    if header is None:
+        return False
+    if header["n_records"] < 0:
+        return True
+    return os.path.getsize(path) < header["header_bytes"] + header["n_records"] * header["record_bytes"]
+
+def edf_is_empty(path, header):
+    """True for an EDF file with no data records, or with no bytes at all (header None)."""
+    if header is None:
+        return os.path.getsize(path) == 0
+    return header["n_records"] == 0 or os.path.getsize(path) <= header["header_bytes"]
+
+def therapy_night(start):
+    """YYYYMMDD of the therapy night a recording starting at start belongs to, so 01:30 counts as the night before."""
+    return (start - timedelta(hours=THERAPY_DAY_START_HOUR)).strftime("%Y%m%d")
+
+def edf_session(name):
+    """Session key of a DATALOG EDF file: the YYYYMMDD_HHMMSS its name starts with, else its stem."""
+    parts = Path(name).stem.split("_")
+    if len(parts) >= 3 and parts[0].isdigit() and parts[1].isdigit():
+        return f"{parts[0]}_{parts[1]}"
+    return Path(name).stem
+
+# --- Streaming Uploads ---
+# Upload bodies are read from disk CHUNK_SIZE bytes at a time as they are sent,
+# never assembled in memory, so an upload costs the same whatever the file size.
+# Each upload in flight holds one such buffer from UPLOAD_BUDGET, which caps the
+# memory spent on uploads across all stages, nights and profiles together.
+class MemoryBudget:
+    """Byte budget shared by concurrent uploads; reserve() blocks until it fits."""
+
+    def __init__(self, limit):
+        self.limit = max(limit, 1)
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size=CHUNK_SIZE):
+        size = min(size, self.limit)  # An oversized reservation still runs, alone
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_use + size <= self.limit)
+            self.in_use += size
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= size
+                self._cond.notify_all()
+
+
+UPLOAD_BUDGET = MemoryBudget(UPLOAD_MEMORY_BUDGET_KB * 1024)
+
+
+class MultipartStream:
+    """Multipart request body whose file parts are streamed from disk.
+
+    parts is a list of (headers, content) where content is bytes or a Path.
+    requests and httplib2 both take it as a body: len() gives them the
+    Content-Length, and seek()/tell() let a retried request start over.
+    """
+
+    def __init__(self, parts, subtype="form-data"):
+        boundary = os.urandom(16).hex()
+        self.content_type = f"multipart/{subtype}; boundary={boundary}"
+        self._segments = []
+        for headers, content in parts:
+            head = f"--{boundary}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+            self._segments += [head.encode(), content, b"\r\n"]
+        self._segments.append(f"--{boundary}--\r\n".encode())
+        self._sizes = [len(seg) if isinstance(seg, bytes) else os.path.getsize(seg) for seg in self._segments]
+        self._length = sum(self._sizes)
+        self._pos = 0
+        self._files = {}
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(lambda: self.read(CHUNK_SIZE), b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._length}[whence]
+        self._pos = min(max(base + offset, 0), self._length)
+        return self._pos
+
+    def read(self, size=-1):
+        """Read up to size bytes; file parts are read from disk CHUNK_SIZE bytes at a time."""
+        if size is None or size < 0:
+            size = self._length - self._pos
+        out = []
+        while size > 0 and self._pos < self._length:
+            index, offset = 0, self._pos
+            while offset >= self._sizes[index]:
+                offset -= self._sizes[index]
+                index += 1
+            segment = self._segments[index]
+            take = min(size, self._sizes[index] - offset)
+            if isinstance(segment, bytes):
+                chunk = segment[offset:offset + take]
+            else:
+                if index not in self._files:
+                    self._files[index] = open(segment, "rb")
+                f = self._files[index]
+                f.seek(offset)
+                chunk = f.read(min(take, CHUNK_SIZE))
+                if not chunk:
+                    raise OSError(f"{segment} shrank while being uploaded")
+            out.append(chunk)
+            self._pos += len(chunk)
+            size -= len(chunk)
+        return b"".join(out)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+# --- SleepHQ Client ---
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+IMPORT_REJECTED_STATUS = {404, 410, 422}  # SleepHQ no longer knows the import or won't take more files for it
+IMPORT_MAX_REOPENS = 3  # Failed processing attempts before a journalled import is given up for a fresh one
+
+
+class ImportRejected(Exception):
+    """SleepHQ refused the import itself, not just one request to it."""
+
+    def __init__(self, import_id, error):
+        super().__init__(f"SleepHQ rejected import {import_id}: {error}")
+        self.import_id = import_id
+
+
+def import_rejected(error):
+    return (isinstance(error, requests.HTTPError) and error.response is not None
+            and error.response.status_code in IMPORT_REJECTED_STATUS)
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def pooled_session(pool_size):
+    """requests.Session keeping up to pool_size connections alive per host."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+class SleepHQClient:
+    """One pooled requests.Session for all SleepHQ API calls.
+
+    Transient failures (connection errors, timeouts, 429 and 5xx responses)
+    are retried with exponential backoff and jitter. File uploads carry their
+    content_hash, so a retried upload is idempotent on the SleepHQ side.
+    Account settings default to the .env values. A session passed in is
+    shared with other clients (one connection pool per host) and is not
+    closed by close().
+
+    Access and refresh tokens are kept in token_file (owner-only) with their
+    expiry, so a run reuses the last run's token instead of logging in. Tokens
+    are refreshed shortly before they expire, and a 401 response triggers one
+    re-authentication and retry.
+    """
+
+    def __init__(self, team_id=None, max_workers=None, client_id=None, client_secret=None,
+                 username=None, password=None, session=None, token_file=None):
+        self.team_id = team_id or TEAM_ID
+        self.max_workers = max_workers or SLEEPHQ_MAX_WORKERS
+        self.client_id = client_id or CLIENT_ID
+        self.client_secret = client_secret or CLIENT_SECRET
+        self.username = username or USERNAME
+        self.password = password or PASSWORD
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = None  # Epoch seconds; None if the server gave no expiry
+        self.token_file = token_file
+        self._token_lock = threading.Lock()
+        self.owns_session = session is None
+        self.session = session if session is not None else pooled_session(self.max_workers)
+        self._load_tokens()
+
+    def close(self):
+        if self.owns_session:
+            self.session.close()
+
+    def _load_tokens(self):
+        cached = load_json_state(self.token_file)
+        # Tokens cached for other credentials (changed .env or profile) are not reused
+        if cached.get("account") == [self.client_id, self.username]:
+            self.access_token = cached.get("access_token")
+            self.refresh_token = cached.get("refresh_token")
+            self.expires_at = cached.get("expires_at")
+
+    def _save_tokens(self):
+        if not self.token_file:
+            return
+        try:
+            save_json_state({
+                "account": [self.client_id, self.username],
+                "access_token": self.access_token,
+                "refresh_token": self.refresh_token,
+                "expires_at": self.expires_at,
+            }, self.token_file, private=True)
+        except Exception as e:
+            log_error(f"Failed to cache SleepHQ token: {e}")
+
+    def _headers(self, token, accept="application/vnd.api+json"):
+        return {"Authorization": f"Bearer {token}", "accept": accept}
+
+    def _with_retries(self, send, description, retry_on_timeout=True, span=None):
+        """Call send() until it returns a non-retryable response or retries run out.
+
+        Retries are counted on span when one is given and logged as warnings;
+        only the error raised once they run out is the caller's to report.
+        """
+        for attempt in range(SLEEPHQ_MAX_RETRIES + 1):
+            try:
+                response = send()
+            except requests.ReadTimeout as e:
+                # The server may already have acted on the request
+                if not retry_on_timeout:
+                    raise
+                error = e
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in RETRYABLE_STATUS:
+                    response.raise_for_status()
+                    return response
+                error = requests.HTTPError(f"{response.status_code} from SleepHQ", response=response)
+            if attempt == SLEEPHQ_MAX_RETRIES:
+                raise error  # The caller logs the final failure
+            delay = backoff_delay(attempt)
+            log_warning(f"{description} failed ({error}), retrying in {delay:.1f}s")
+            if span is not None:
+                span["retries"] += 1
+            time.sleep(delay)
+
+    def _token_request(self, data, description):
+        """POST a grant to the token endpoint, keep the new tokens and cache them."""
+        data = dict(data, client_id=self.client_id, client_secret=self.client_secret)
+        headers = {"accept": "application/json"}
+        with current_metrics().span("sleephq_auth") as span:
+            response = self._with_retries(
+                lambda: self.session.post(OAUTH_TOKEN_URL, data=data, headers=headers, timeout=SLEEPHQ_TIMEOUT),
+                description,
+                span=span,
+            )
+        token = response.json()
+        self.access_token = token["access_token"]
+        self.refresh_token = token.get("refresh_token", self.refresh_token)
+        self.expires_at = time.time() + token["expires_in"] if token.get("expires_in") else None
+        self._save_tokens()
+        return self.access_token
+
+    def authenticate(self):
+        """Log in with the account password (password grant)."""
+        try:
+            self._token_request({
+                "grant_type": "password",
+                "username": self.username,
+                "password": self.password,
+                "scope": "read write"
+            }, "SleepHQ authentication")
+            log_success("Authenticated with SleepHQ")
+            return self.access_token
+        except Exception as e:
+            log_error(f"Failed to authenticate with SleepHQ: {e}")
+            raise
+
+    def ensure_token(self, rejected=None):
+        """A usable access token: the current one, a refreshed one, or a new login.
+
+        rejected is a token the API just answered 401 to; it is replaced unless
+        another thread already did so.
+        """
+        with self._token_lock:
+            fresh = self.expires_at is None or time.time() < self.expires_at - SLEEPHQ_TOKEN_REFRESH_MARGIN
+            if self.access_token and self.access_token != rejected and fresh:
+                return self.access_token
+            if self.refresh_token:
+                try:
+                    self._token_request({"grant_type": "refresh_token", "refresh_token": self.refresh_token},
+                                        "SleepHQ token refresh")
+                    log_success("Refreshed SleepHQ access token")
+                    return self.access_token
+                except Exception as e:
+                    log_warning(f"Failed to refresh SleepHQ token, logging in again: {e}")
+                    self.refresh_token = None
+            return self.authenticate()
+
+    def _authorized(self, send, description, retry_on_timeout=True, span=None):
+        """_with_retries for API calls; send(headers) gets auth headers and is retried once after a 401."""
+        token = self.ensure_token()
+        try:
+            return self._with_retries(lambda: send(self._headers(token)), description, retry_on_timeout, span)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 401:
+                raise
+        log_warning(f"{description} was refused with 401, re-authenticating")
+        token = self.ensure_token(rejected=token)
+        return self._with_retries(lambda: send(self._headers(token)), description, retry_on_timeout, span)
+
+    def create_import(self):
+        try:
+            url = f"{BASE_API_URL}/teams/{self.team_id}/imports"
+            # Not retried after a read timeout: the import may already exist
+            with current_metrics().span("sleephq_create_import") as span:
+                response = self._authorized(
+                    lambda headers: self.session.post(url, json={"programatic": False},
+                                                      headers=dict(headers, **{"Content-Type": "application/json"}),
+                                                      timeout=SLEEPHQ_TIMEOUT),
+                    "Create import",
+                    retry_on_timeout=False,
+                    span=span,
+                )
+            import_id = response.json()["data"]["id"]
+            log_success(f"Created Import ID: {import_id}")
+            return import_id
+        except Exception as e:
+            log_error(f"Failed to create import: {e}")
+            raise
+
+    def upload_file(self, import_id, file_path, relative_path, content_hash=None):
+        with current_metrics().span("sleephq_upload") as span:
+            try:
+                url = f"{BASE_API_URL}/imports/{import_id}/files"
+                if content_hash is None:
+                    content_hash = sha256_of_file(file_path)
+                data = {
+                    "name": file_path.name,
+                    "path": str(relative_path),
+                    "content_hash": content_hash
+                }
+                parts = [({"Content-Disposition": f'form-data; name="{name}"'}, str(value).encode())
+                         for name, value in data.items()]
+                filename = file_path.name.replace('"', "%22")
+                parts.append(({"Content-Disposition": f'form-data; name="file"; filename="{filename}"'}, file_path))
+                with UPLOAD_BUDGET.reserve(), MultipartStream(parts) as body:
+                    def send(headers):
+                        body.seek(0)
+                        return self.session.post(url, headers=dict(headers, **{"Content-Type": body.content_type}),
+                                                 data=body, timeout=SLEEPHQ_TIMEOUT)
+                    self._authorized(send, f"Upload of {file_path.name}", span=span)
+                span["bytes"] = os.path.getsize(file_path)
+                log_success(f"Uploaded file to SleepHQ: {file_path}", file=str(relative_path))
+                return True
+            except Exception as e:
+                span["error"] = type(e).__name__
+                if import_rejected(e):
+                    raise ImportRejected(import_id, e) from e  # The pipeline decides whether that's an error
+                log_error(f"Failed to upload file to SleepHQ: {file_path} - {e}", file=str(relative_path))
+                return False
+
+    def process_import(self, import_id):
+        with current_metrics().span("sleephq_process") as span:
+            try:
+                url = f"{BASE_API_URL}/imports/{import_id}/process_files"
+                self._authorized(
+                    lambda headers: self.session.post(url, headers=headers, timeout=SLEEPHQ_TIMEOUT),
+                    f"Process import {import_id}",
+                    span=span,
+                )
+                log_success(f"Processed Import ID: {import_id}")
+                return True
+            except Exception as e:
+                span["error"] = type(e).__name__
+                if import_rejected(e):
+                    raise ImportRejected(import_id, e) from e
+                log_error(f"Failed to process import: {import_id} - {e}")
+                return False
 
 # --- Google Drive Helpers ---
 def get_or_create_drive_folder(drive, parent_id, folder_name):
@@ -296,59 +1366,500 @@ def get_or_create_drive_folder(drive, parent_id, folder_name):
     folder.Upload()
     return folder['id']
 
-def upload_to_drive(file_path, date_folder, drive):
-    try:
-        # Create/find date folder
-        date_folder_id = get_or_create_drive_folder(drive, DRIVE_FOLDER_ID, date_folder)
-        file = drive.CreateFile({
-            "title": file_path.name,
-            "parents": [{"id": date_folder_id}]
-        })
-        file.SetContentFile(str(file_path))
-        file.Upload()
-        log_success(f"Uploaded file to Google Drive: {file_path} in {date_folder}")
-        return True
-    except Exception as e:
-        log_error(f"Failed to upload file to Google Drive: {file_path} - {e}")
-        return False
+class DriveBackend:
+    """Authenticated Google Drive client shared by all Drive uploads in a run.
 
-# --- Google Drive Cleanup Helper ---
-def cleanup_drive_dated_folders(days_old):
-    try:
-        gauth = GoogleAuth(settings={
+    Date folder IDs are resolved once and cached (optionally on disk, so they
+    survive between runs). Files are uploaded concurrently, each worker thread
+    using its own authorized http object since httplib2 is not thread-safe.
+    Files larger than one chunk use resumable uploads whose session URI is
+    saved, so an interrupted upload continues where it stopped on the next run.
+    """
+
+    def __init__(self, credentials_json=None, root_folder_id=None, folder_cache_file=None, resume_state_file=None):
+        self.root_folder_id = root_folder_id or DRIVE_FOLDER_ID
+        from pydrive2.auth import GoogleAuth
+        from pydrive2.drive import GoogleDrive
+        self.gauth = GoogleAuth(settings={
             "client_config_backend": "service",
             "service_config": {
-                "client_json_file_path": CREDENTIALS_JSON
+                "client_json_file_path": credentials_json or CREDENTIALS_JSON
             }
         })
-        gauth.ServiceAuth()
-        drive = GoogleDrive(gauth)
-        cutoff_date = datetime.now() - timedelta(days=days_old)
-        # List all folders in the main drive folder
-        folder_list = drive.ListFile({
-            'q': f"'{DRIVE_FOLDER_ID}' in parents and trashed=false and mimeType='application/vnd.google-apps.folder'"
-        }).GetList()
-        for folder in folder_list:
+        self.gauth.ServiceAuth()
+        self.drive = GoogleDrive(self.gauth)
+        self.folder_cache_file = folder_cache_file
+        self.resume_state_file = resume_state_file
+        self.folder_ids = load_json_state(folder_cache_file).get(self.root_folder_id, {})
+        self.resume_state = load_json_state(resume_state_file)
+        self._folder_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _http(self):
+        if not hasattr(self._local, "http"):
+            self._local.http = self.gauth.Get_Http_Object()
+        return self._local.http
+
+    def folder_id(self, date_folder):
+        with self._folder_lock:
+            if date_folder not in self.folder_ids:
+                self.folder_ids[date_folder] = get_or_create_drive_folder(
+                    self.drive, self.root_folder_id, date_folder)
+                self._save_folder_cache()
+            return self.folder_ids[date_folder]
+
+    def forget_folder(self, date_folder):
+        with self._folder_lock:
+            if self.folder_ids.pop(date_folder, None) is not None:
+                self._save_folder_cache()
+
+    def _list(self, query, fields):
+        """All items matching query, following pagination; fields selects the item fields returned."""
+        files = self.drive.auth.service.files()
+        items, page_token = [], None
+        while True:
+            result = files.list(q=query, maxResults=1000, pageToken=page_token,
+                                fields=f"nextPageToken,{fields}").execute(http=self._http())
+            items.extend(result.get("items", []))
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return items
+
+    def list_folders(self):
+        """(id, title) of every folder directly under the backup root."""
+        query = (f"'{self.root_folder_id}' in parents and trashed=false"
+                 " and mimeType='application/vnd.google-apps.folder'")
+        return [(item["id"], item["title"]) for item in self._list(query, "items(id,title)")]
+
+    def folder_sizes(self, folder_ids):
+        """{folder_id: (file count, total bytes)} for the given folders, listed 40 folders per query."""
+        sizes = {folder_id: (0, 0) for folder_id in folder_ids}
+        for start in range(0, len(folder_ids), 40):
+            parents = " or ".join(f"'{folder_id}' in parents" for folder_id in folder_ids[start:start + 40])
+            for item in self._list(f"({parents}) and trashed=false", "items(fileSize,parents(id))"):
+                for parent in item.get("parents", []):
+                    if parent["id"] in sizes:
+                        files, nbytes = sizes[parent["id"]]
+                        sizes[parent["id"]] = (files + 1, nbytes + int(item.get("fileSize", 0)))
+        return sizes
+
+    def delete_files(self, file_ids):
+        """Delete files or folders through the batch endpoint; returns {file_id: error} for those that failed."""
+        service = self.drive.auth.service
+        failed = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                failed[request_id] = exception
+
+        for start in range(0, len(file_ids), DRIVE_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for file_id in file_ids[start:start + DRIVE_BATCH_SIZE]:
+                batch.add(service.files().delete(fileId=file_id), request_id=file_id)
+            batch.execute(http=self._http())
+        return failed
+
+    def _save_folder_cache(self):
+        if self.folder_cache_file:
+            cache = load_json_state(self.folder_cache_file)
+            cache[self.root_folder_id] = self.folder_ids
+            save_json_state(cache, self.folder_cache_file)
+
+    def _set_resume_state(self, key, value):
+        with self._state_lock:
+            if value is None:
+                self.resume_state.pop(key, None)
+            else:
+                self.resume_state[key] = value
+            if self.resume_state_file:
+                save_json_state(self.resume_state, self.resume_state_file)
+
+    def _resume_session(self, http, request, uri, size):
+        """Reattach request to a saved upload session; returns True if it already completed."""
+        resp, _ = http.request(uri, "PUT", headers={"Content-Range": f"bytes */{size}", "content-length": "0"})
+        if resp.status in (200, 201):
+            return True
+        if resp.status == 308:
+            request.resumable_uri = uri
+            request.resumable_progress = int(resp["range"].split("-")[1]) + 1 if "range" in resp else 0
+            log_success(f"Resuming Drive upload at byte {request.resumable_progress} of {size}")
+        # Anything else means the session expired; start a new one
+        return False
+
+    def find_child(self, parent_id, title, folder=False):
+        """ID of the non-trashed file (or folder) called title under parent_id, or None."""
+        query = f"'{parent_id}' in parents and title='{title}' and trashed=false"
+        if folder:
+            query += " and mimeType='application/vnd.google-apps.folder'"
+        result = self.drive.auth.service.files().list(q=query, maxResults=1).execute(http=self._http())
+        items = result.get("items", [])
+        return items[0]["id"] if items else None
+
+    def read_range(self, file_id, offset, length):
+        """Download length bytes of a Drive file starting at offset."""
+        url = f"https://www.googleapis.com/drive/v2/files/{file_id}?alt=media"
+        resp, content = self._http().request(url, "GET", headers={"Range": f"bytes={offset}-{offset + length - 1}"})
+        if resp.status not in (200, 206):
+            raise RuntimeError(f"Drive download of {file_id} failed with HTTP {resp.status}")
+        return content if resp.status == 206 else content[offset:offset + length]
+
+    def _upload_file(self, file_path, folder_id, replace=False):
+        from googleapiclient.http import MediaFileUpload
+        http = self._http()
+        st = os.stat(file_path)
+        files = self.drive.auth.service.files()
+        existing_id = self.find_child(folder_id, file_path.name) if replace else None
+        metadata = {"title": file_path.name, "parents": [{"id": folder_id}]}
+
+        def make_request(media):
+            if existing_id:
+                return files.update(fileId=existing_id, body={"title": file_path.name}, media_body=media)
+            return files.insert(body=metadata, media_body=media)
+
+        if st.st_size <= DRIVE_CHUNK_SIZE:
+            # One multipart request beats a two-step resumable session for small files
+            self._upload_multipart(http, file_path, existing_id, {"title": file_path.name} if existing_id else metadata)
+            return
+        # Resumable chunks are streamed from the file by googleapiclient, not read into memory
+        media = MediaFileUpload(str(file_path), mimetype="application/octet-stream",
+                                chunksize=DRIVE_CHUNK_SIZE, resumable=True)
+        request = make_request(media)
+        key = f"{folder_id}/{file_path}"
+        saved = self.resume_state.get(key)
+        if saved and (saved["size"], saved["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+            if self._resume_session(http, request, saved["uri"], st.st_size):
+                self._set_resume_state(key, None)
+                return
+        response = None
+        while response is None:
+            _, response = request.next_chunk(http=http, num_retries=DRIVE_MAX_RETRIES)
+            if response is None and (not saved or saved["uri"] != request.resumable_uri):
+                saved = {"uri": request.resumable_uri, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+                self._set_resume_state(key, saved)
+        self._set_resume_state(key, None)
+
+    def _upload_multipart(self, http, file_path, existing_id, metadata):
+        """Single-request upload with a streamed multipart body (googleapiclient builds it in memory)."""
+        from googleapiclient.errors import HttpError
+        url = "https://www.googleapis.com/upload/drive/v2/files"
+        method = "POST"
+        if existing_id:
+            url, method = f"{url}/{existing_id}", "PUT"
+        url += "?uploadType=multipart"
+        parts = [({"Content-Type": "application/json; charset=UTF-8"}, json.dumps(metadata).encode()),
+                 ({"Content-Type": "application/octet-stream"}, file_path)]
+        with MultipartStream(parts, "related") as body:
+            resp, content = http.request(url, method, body=body,
+                                         headers={"Content-Type": body.content_type, "Content-Length": str(len(body))})
+        if resp.status >= 300:
+            raise HttpError(resp, content, uri=url)
+
+    def upload(self, file_path, date_folder, replace=False):
+        """Upload file_path into date_folder; with replace, overwrite a same-named file there."""
+        from googleapiclient.errors import HttpError
+        try:
+            try:
+                with UPLOAD_BUDGET.reserve():
+                    self._upload_file(file_path, self.folder_id(date_folder), replace)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                # Cached folder was deleted on the Drive side; look it up again
+                self.forget_folder(date_folder)
+                with UPLOAD_BUDGET.reserve():
+                    self._upload_file(file_path, self.folder_id(date_folder), replace)
+            log_success(f"Uploaded file to Google Drive: {file_path} in {date_folder}", file=str(file_path))
+            return True
+        except Exception as e:
+            log_error(f"Failed to upload file to Google Drive: {file_path} - {e}", file=str(file_path))
+            return False
+
+# --- Retention ---
+# Everything that expires is named by date: DATALOG/<YYYYMMDD> folders locally
+# and on the card, archives/<YYYYMMDD>.tar.* locally, and <YYYYMMDD> folders on
+# Drive. Retention only looks at those names, so its cost follows the number of
+# days kept rather than the number of files. Each prune returns folder, file
+# and byte counts, which are also what a dry run reports.
+LOCAL_DATED_DIRS = ("DATALOG", "archives")
+
+def retention_expired(name, cutoff):
+    """True for a YYYYMMDD folder (or YYYYMMDD.<ext> file) dated before cutoff."""
+    try:
+        return datetime.strptime(name.split(".", 1)[0], "%Y%m%d") < cutoff
+    except ValueError:
+        return False
+
+def local_tree_size(path):
+    """(file count, total bytes) under path, or of path itself when it is a file."""
+    if not os.path.isdir(path):
+        return 1, os.path.getsize(path)
+    files, nbytes = 0, 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            nbytes += os.path.getsize(os.path.join(dirpath, filename))
+    return files, nbytes
+
+def prune_local(download_dir, days_old, dry_run=False):
+    cutoff = datetime.now() - timedelta(days=days_old)
+    totals = {"folders": 0, "files": 0, "bytes": 0}
+    for subdir in LOCAL_DATED_DIRS:
+        try:
+            entries = [entry for entry in os.scandir(Path(download_dir) / subdir)
+                       if retention_expired(entry.name, cutoff)]
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            log_error(f"Failed to list local data: {Path(download_dir) / subdir} - {e}")
+            continue
+        for entry in entries:
             try:
-                folder_name = folder['title']
-                # Expecting folder_name to be a date string like YYYYMMDD
-                folder_date = datetime.strptime(folder_name, "%Y%m%d")
-                if folder_date < cutoff_date:
-                    folder.Delete()
-                    log_success(f"Deleted old folder from Google Drive: {folder_name}")
-            except ValueError:
-                # Skip folders that don't match the date format
+                files, nbytes = local_tree_size(entry.path)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not dry_run:
+                    if is_dir:
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+                    log_success(f"Deleted old local data: {entry.path}")
+                totals["folders"] += is_dir
+                totals["files"] += files
+                totals["bytes"] += nbytes
+            except Exception as e:
+                log_error(f"Failed to delete local data: {entry.path} - {e}")
+    return totals
+
+def prune_flashair(flashair, base_dir, days_old, dry_run=False):
+    cutoff = datetime.now() - timedelta(days=days_old)
+    folders = [path for path in flashair.list_dirs(base_dir) if retention_expired(path.rsplit("/", 1)[-1], cutoff)]
+    if not folders:
+        return {"folders": 0, "files": 0, "bytes": 0}
+    sizes = {}
+    for entry in flashair.list_entries(folders):
+        folder = entry["path"].rsplit("/", 1)[0]
+        files, nbytes = sizes.get(folder, (0, 0))
+        sizes[folder] = (files + 1, nbytes + entry["size"])
+    if not dry_run:
+        folders = flashair.delete_many(folders)
+    return {
+        "folders": len(folders),
+        "files": sum(sizes.get(folder, (0, 0))[0] for folder in folders),
+        "bytes": sum(sizes.get(folder, (0, 0))[1] for folder in folders),
+    }
+
+def prune_drive(drive, days_old, dry_run=False):
+    cutoff = datetime.now() - timedelta(days=days_old)
+    totals = {"folders": 0, "files": 0, "bytes": 0}
+    try:
+        expired = [(folder_id, title) for folder_id, title in drive.list_folders()
+                   if retention_expired(title, cutoff)]
+        if not expired:
+            return totals
+        sizes = drive.folder_sizes([folder_id for folder_id, _ in expired])
+        failed = {} if dry_run else drive.delete_files([folder_id for folder_id, _ in expired])
+        for folder_id, title in expired:
+            if folder_id in failed:
+                log_error(f"Failed to delete old folder from Google Drive: {title} - {failed[folder_id]}")
                 continue
+            if not dry_run:
+                drive.forget_folder(title)
+                log_success(f"Deleted old folder from Google Drive: {title}")
+            totals["folders"] += 1
+            totals["files"] += sizes[folder_id][0]
+            totals["bytes"] += sizes[folder_id][1]
     except Exception as e:
         log_error(f"Failed to clean up old folders in Google Drive: {e}")
+    return totals
+
+# --- Nightly Archive ---
+# Archive mode packs a night's files into one tar object per Drive date folder.
+# Every tar member is compressed as its own gzip member / zstd frame, so the
+# whole object is still an ordinary .tar.gz/.tar.zst, but any single file can
+# be read back with one ranged download. The first member is MANIFEST.json,
+# listing each file's size, SHA-256 and frame offset/length (relative to the
+# end of the manifest frame).
+ARCHIVE_MANIFEST_NAME = "MANIFEST.json"
+ARCHIVE_SUFFIXES = {"gzip": ".tar.gz", "zstd": ".tar.zst"}
+ARCHIVE_MAGIC = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd"}
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd archives need the 'zstandard' package (pip install zstandard)")
+    return zstandard
+
+def archive_compressor(compression):
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor().compressobj()
+    raise ValueError(f"Unknown archive compression: {compression}")
+
+def archive_decompressor(compression):
+    if compression == "gzip":
+        return zlib.decompressobj(31)
+    if compression == "zstd":
+        return _zstandard().ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown archive compression: {compression}")
+
+def _write_frame(out, compression, chunks):
+    """Compress chunks as one self-contained frame appended to out; returns (offset, length)."""
+    offset = out.tell()
+    compressor = archive_compressor(compression)
+    for chunk in chunks:
+        out.write(compressor.compress(chunk))
+    out.write(compressor.flush())
+    return offset, out.tell() - offset
+
+def _tar_member_chunks(tarinfo, source, digest=None):
+    """Yield a tar header, the member data from source (file object) and block padding."""
+    yield tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+    while chunk := source.read(CHUNK_SIZE):
+        if digest is not None:
+            digest.update(chunk)
+        yield chunk
+    if tarinfo.size % tarfile.BLOCKSIZE:
+        yield tarfile.NUL * (tarfile.BLOCKSIZE - tarinfo.size % tarfile.BLOCKSIZE)
+
+def write_archive(files, archive_path, compression):
+    """Pack (arcname, local_path) pairs into archive_path; returns the manifest's file list."""
+    archive_path = Path(archive_path)
+    os.makedirs(archive_path.parent, exist_ok=True)
+    members_path = archive_path.with_name(archive_path.name + ".members")
+    manifest = {"version": 1, "compression": compression, "created": datetime.now().isoformat(), "files": []}
+    try:
+        with open(members_path, "w+b") as members:
+            for arcname, local_path in files:
+                st = os.stat(local_path)
+                tarinfo = tarfile.TarInfo(arcname)
+                tarinfo.size = st.st_size
+                tarinfo.mtime = int(st.st_mtime)
+                digest = hashlib.sha256()
+                with open(local_path, "rb") as f:
+                    offset, length = _write_frame(members, compression, _tar_member_chunks(tarinfo, f, digest))
+                manifest["files"].append({"path": arcname, "size": st.st_size, "sha256": digest.hexdigest(),
+                                          "offset": offset, "length": length})
+            _write_frame(members, compression, [tarfile.NUL * (2 * tarfile.BLOCKSIZE)])  # End-of-archive
+            manifest_bytes = json.dumps(manifest, indent=1).encode()
+            tarinfo = tarfile.TarInfo(ARCHIVE_MANIFEST_NAME)
+            tarinfo.size = len(manifest_bytes)
+            tarinfo.mtime = int(time.time())
+            tmp_path = archive_path.with_name(archive_path.name + ".part")
+            with open(tmp_path, "wb") as out:
+                _write_frame(out, compression, _tar_member_chunks(tarinfo, io.BytesIO(manifest_bytes)))
+                members.seek(0)
+                while chunk := members.read(CHUNK_SIZE):
+                    out.write(chunk)
+            os.replace(tmp_path, archive_path)
+    finally:
+        try:
+            os.remove(members_path)
+        except OSError:
+            pass
+    return manifest["files"]
+
+class ArchiveReader:
+    """Random access to an archive through read_range(offset, length), local or on Drive."""
+
+    def __init__(self, read_range):
+        self.read_range = read_range
+        head = read_range(0, 4)
+        self.compression = ARCHIVE_MAGIC.get(head[:2]) or ARCHIVE_MAGIC.get(head)
+        if self.compression is None:
+            raise ValueError("Not a packed nightly archive")
+        raw, self.data_start = self._read_first_frame()
+        self.manifest = json.loads(self._member_data(raw))
+
+    def _read_first_frame(self):
+        decompressor = archive_decompressor(self.compression)
+        raw, offset = b"", 0
+        while not decompressor.eof:
+            chunk = self.read_range(offset, CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("Archive is truncated")
+            raw += decompressor.decompress(chunk)
+            offset += len(chunk)
+        return raw, offset - len(decompressor.unused_data)
+
+    @staticmethod
+    def _member_data(raw):
+        with tarfile.open(fileobj=io.BytesIO(raw), mode="r:") as tar:
+            return tar.extractfile(tar.next()).read()
+
+    def read(self, entry):
+        """Contents of one manifest entry, checked against its recorded SHA-256."""
+        frame = self.read_range(self.data_start + entry["offset"], entry["length"])
+        data = self._member_data(archive_decompressor(self.compression).decompress(frame))
+        if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+            raise ValueError(f"Checksum mismatch for {entry['path']}")
+        return data
+
+def local_range_reader(path):
+    def read_range(offset, length):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+    return read_range
+
+def open_archive(source, profile=None):
+    """ArchiveReader for a local archive path, or a night (YYYYMMDD) or YYYYMMDD.settings archive on Drive."""
+    if os.path.exists(source):
+        return ArchiveReader(local_range_reader(source))
+    drive = (profile or Profile()).drive_backend()
+    folder = source.split(".", 1)[0]
+    folder_id = drive.find_child(drive.root_folder_id, folder, folder=True)
+    if folder_id is None:
+        raise FileNotFoundError(f"No Drive folder named {folder}")
+    for suffix in ARCHIVE_SUFFIXES.values():
+        file_id = drive.find_child(folder_id, f"{source}{suffix}")
+        if file_id:
+            return ArchiveReader(lambda offset, length: drive.read_range(file_id, offset, length))
+    raise FileNotFoundError(f"No archive {source} in Drive folder {folder}")
+
+def restore_archive(source, patterns=None, verify=False, output_dir=None, profile=None):
+    """List, verify or extract files from a nightly archive; returns an exit code.
+
+    Only the manifest and the selected members are downloaded.
+    """
+    try:
+        reader = open_archive(source, profile)
+    except Exception as e:
+        log_error(f"Failed to open archive {source}: {e}", step="Restore")
+        return 1
+    entries = reader.manifest["files"]
+    if patterns:
+        entries = [entry for entry in entries if any(fnmatch.fnmatch(entry["path"], p) for p in patterns)]
+    if not verify and output_dir is None:
+        for entry in entries:
+            print(f"{entry['size']:>12}  {entry['sha256']}  {entry['path']}")
+        return 0
+    failed = 0
+    for entry in entries:
+        try:
+            data = reader.read(entry)
+            if output_dir is not None:
+                target = Path(output_dir) / entry["path"]
+                os.makedirs(target.parent, exist_ok=True)
+                target.write_bytes(data)
+                log_success(f"Restored {entry['path']} to {target}", step="Restore", file=entry["path"])
+            else:
+                log_success(f"Verified {entry['path']}", step="Restore", file=entry["path"])
+        except Exception as e:
+            failed += 1
+            log_error(f"Failed to restore {entry['path']}: {e}", step="Restore", file=entry["path"])
+    return 1 if failed else 0
 
 # --- Email Notification ---
-def send_email_notification(subject, body):
+def send_email_notification(subject, body, recipient=None):
     try:
+        import smtplib
+        from email.mime.text import MIMEText
         msg = MIMEText(body)
         msg["Subject"] = subject
         msg["From"] = GMAIL_USERNAME
-        msg["To"] = NOTIFICATION_EMAIL
+        msg["To"] = recipient or NOTIFICATION_EMAIL
         with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
             server.starttls()
             server.login(GMAIL_USERNAME, GMAIL_APP_PASSWORD)
@@ -361,200 +1872,1031 @@ def send_email_notification(subject, body):
 def sha256_of_file(file_path):
     sha256_hash = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
             sha256_hash.update(chunk)
     return sha256_hash.hexdigest()
 
-def load_hash_log(log_file):
-    """Load the hash log and only keep entries for the last 7 days."""
-    if not log_file.exists():
-        return set()
-    cutoff = datetime.now() - timedelta(days=7)
-    valid_hashes = set()
-    lines = []
-    with open(log_file, "r") as f:
-        for line in f:
+# --- Dedup Store ---
+class DedupStore:
+    """SQLite store of file hashes, upload status, downloads, the EDF index and the run journal."""
+
+    def __init__(self, db_path, legacy_log=None, legacy_manifest=None):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_updated_at ON files (updated_at);
+                CREATE TABLE IF NOT EXISTS uploads (
+                    sha256 TEXT NOT NULL,
+                    destination TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    path TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (sha256, destination)
+                );
+                CREATE INDEX IF NOT EXISTS uploads_updated_at ON uploads (updated_at);
+                CREATE TABLE IF NOT EXISTS edf_index (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    night TEXT NOT NULL,
+                    session TEXT NOT NULL,
+                    n_records INTEGER NOT NULL,
+                    duration REAL,
+                    header TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS edf_index_night ON edf_index (night);
+                CREATE TABLE IF NOT EXISTS imports (
+                    key TEXT PRIMARY KEY,
+                    import_id TEXT,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    reopens INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS manifest (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    date INTEGER NOT NULL,
+                    time INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS manifest_updated_at ON manifest (updated_at);
+                CREATE TABLE IF NOT EXISTS journal_files (
+                    key TEXT NOT NULL,
+                    destination TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    path TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (key, destination, sha256)
+                );
+            """)
+            if "reopens" not in {row[1] for row in self.conn.execute("PRAGMA table_info(imports)")}:
+                self.conn.execute("ALTER TABLE imports ADD COLUMN reopens INTEGER NOT NULL DEFAULT 0")
+            # Backfill checkpoints used to be kept per import, for SleepHQ only
+            if self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'import_files'").fetchone():
+                self.conn.executescript("""
+                    INSERT OR IGNORE INTO journal_files
+                        SELECT imports.key, 'sleephq', import_files.sha256, import_files.path, import_files.updated_at
+                        FROM import_files JOIN imports USING (import_id);
+                    DROP TABLE import_files;
+                """)
+        if legacy_log is not None and legacy_log.exists():
+            self._migrate_hash_log(legacy_log)
+        if legacy_manifest is not None and legacy_manifest.exists():
+            self._migrate_sync_manifest(legacy_manifest)
+
+    @contextmanager
+    def _durable(self):
+        """Transaction that is fsynced on commit, for journal records a power cut must not lose."""
+        with self.lock:
+            self.conn.execute("PRAGMA synchronous=FULL")
             try:
-                hash_str, date_str = line.strip().split(",")
-                log_date = datetime.strptime(date_str, "%Y-%m-%d")
-                if log_date >= cutoff:
-                    valid_hashes.add(hash_str)
-                    lines.append(line)
-            except Exception:
-                continue
-    # Rewrite log file with only recent entries
-    with open(log_file, "w") as f:
-        f.writelines(lines)
-    return valid_hashes
+                with self.conn:
+                    yield self.conn
+            finally:
+                self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _migrate_hash_log(self, log_file):
+        """Import the old uploaded_hashes.log (hash,YYYY-MM-DD per line) once."""
+        rows = []
+        with open(log_file, "r") as f:
+            for line in f:
+                try:
+                    hash_str, date_str = line.strip().split(",")
+                    logged_at = datetime.strptime(date_str, "%Y-%m-%d").timestamp()
+                except Exception:
+                    continue
+                rows.append((hash_str, "sleephq", "uploaded", None, logged_at))
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO uploads VALUES (?, ?, ?, ?, ?)", rows)
+        os.replace(log_file, log_file.with_name(log_file.name + ".migrated"))
+        log_success(f"Migrated {len(rows)} entries from {log_file} to the dedup store")
+
+    def _migrate_sync_manifest(self, manifest_file):
+        """Import the old sync_manifest.json (remote path -> size, date, time, sha256) once."""
+        now = time.time()
+        rows = [(path, known["size"], known["date"], known["time"], known["sha256"], now)
+                for path, known in load_json_state(manifest_file).items()
+                if isinstance(known, dict) and known.keys() >= {"size", "date", "time", "sha256"}]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO manifest VALUES (?, ?, ?, ?, ?, ?)", rows)
+        os.replace(manifest_file, manifest_file.with_name(manifest_file.name + ".migrated"))
+        log_success(f"Migrated {len(rows)} entries from {manifest_file} to the dedup store")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def cached_hash(self, path, size, mtime_ns):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (str(path), size, mtime_ns),
+            ).fetchone()
+        return row[0] if row else None
+
+    def remember_hash(self, path, file_hash):
+        st = os.stat(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (str(path), st.st_size, st.st_mtime_ns, file_hash, time.time()),
+            )
+
+    def hash_for(self, path):
+        """Return the file's SHA-256, hashing it only if size or mtime changed."""
+        st = os.stat(path)
+        file_hash = self.cached_hash(path, st.st_size, st.st_mtime_ns)
+        if file_hash is None:
+            with current_metrics().span("hash", nbytes=st.st_size):
+                file_hash = sha256_of_file(path)
+            self.remember_hash(path, file_hash)
+        return file_hash
+
+    def downloaded(self, remote_path):
+        """Listing fields and SHA-256 of the card file as last downloaded ({size, date, time, sha256}), or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT size, date, time, sha256 FROM manifest WHERE path = ?",
+                                    (remote_path,)).fetchone()
+        return dict(zip(("size", "date", "time", "sha256"), row)) if row else None
+
+    def remember_download(self, remote_path, entry, file_hash):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)",
+                (remote_path, entry["size"], entry["date"], entry["time"], file_hash, time.time()),
+            )
+
+    def edf_info(self, path, night):
+        """edf_header() of a DATALOG file plus its session and therapy night, from the index when unchanged.
+
+        The night comes from the recording start; night (the DATALOG folder)
+        is the fallback when the header has none. None if it isn't an EDF file.
+        """
+        st = os.stat(path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT night, session, header FROM edf_index WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (str(path), st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        if row:
+            return dict(json.loads(row[2]), night=row[0], session=row[1])
+        header = edf_header(path)
+        if header is None:
+            return None
+        if header["start"]:
+            night = therapy_night(datetime.fromisoformat(header["start"]))
+        session = edf_session(path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO edf_index VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(path), st.st_size, st.st_mtime_ns, night, session, header["n_records"], header["duration"],
+                 json.dumps(header), time.time()),
+            )
+        return dict(header, night=night, session=session)
+
+    def night_summary(self, night):
+        """(sessions, EDF files, seconds recorded) indexed for one therapy night, ignoring empty files."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT COUNT(*), MAX(duration) FROM edf_index WHERE night = ? AND n_records > 0 GROUP BY session",
+                (night,),
+            ).fetchall()
+        return len(rows), sum(row[0] for row in rows), sum(row[1] or 0 for row in rows)
+
+    def is_uploaded(self, file_hash, destination):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM uploads WHERE sha256 = ? AND destination = ? AND status = 'uploaded'",
+                (file_hash, destination),
+            ).fetchone()
+        return row is not None
+
+    def mark(self, file_hash, destination, status="uploaded", path=None):
+        """Record an upload outcome; a failed retry never downgrades a confirmed upload."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO uploads VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (sha256, destination) DO UPDATE SET
+                       status = excluded.status, path = excluded.path, updated_at = excluded.updated_at
+                   WHERE uploads.status != 'uploaded' OR excluded.status = 'uploaded'""",
+                (file_hash, destination, status, str(path) if path else None, time.time()),
+            )
+
+    def journal(self, key):
+        """(import_id, stage, reopens) journalled under key: stage is "open", "processing" or "done",
+        reopens how often processing failed and the import was reopened; (None, None, 0) if none."""
+        with self.lock:
+            row = self.conn.execute("SELECT import_id, status, reopens FROM imports WHERE key = ?", (key,)).fetchone()
+        return tuple(row) if row else (None, None, 0)
+
+    def begin_import(self, key, import_id):
+        with self._durable() as conn:
+            conn.execute("INSERT OR REPLACE INTO imports (key, import_id, status, updated_at) VALUES (?, ?, 'open', ?)",
+                         (key, import_id, time.time()))
+
+    def reopen_import(self, key):
+        """Put the import under key back to "open" after processing failed."""
+        with self._durable() as conn:
+            conn.execute("UPDATE imports SET status = 'open', reopens = reopens + 1, updated_at = ? WHERE key = ?",
+                         (time.time(), key))
+
+    def abandon_import(self, key):
+        """Forget the import under key and what was sent to it, so the next attempt starts a fresh import."""
+        with self._durable() as conn:
+            conn.execute("DELETE FROM journal_files WHERE key = ?", (key,))
+            conn.execute("DELETE FROM imports WHERE key = ?", (key,))
+
+    def set_import_stage(self, key, stage):
+        with self._durable() as conn:
+            conn.execute("UPDATE imports SET status = ?, updated_at = ? WHERE key = ?", (stage, time.time(), key))
+
+    def journal_hashes(self, key, destination):
+        """Content hashes journalled under key as sent to destination."""
+        with self.lock:
+            rows = self.conn.execute("SELECT sha256 FROM journal_files WHERE key = ? AND destination = ?",
+                                     (key, destination)).fetchall()
+        return {row[0] for row in rows}
+
+    def record_sent(self, key, destination, file_hash, path=None):
+        # Not fsynced: losing the last few records after a power cut only means re-sending those files
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO journal_files VALUES (?, ?, ?, ?, ?)",
+                              (key, destination, file_hash, str(path) if path else None, time.time()))
 
-def log_hash(file_hash, log_file):
-    with open(log_file, "a") as f:
-        f.write(f"{file_hash},{datetime.now().strftime('%Y-%m-%d')}\n")
+    def finish_import(self, key):
+        """Close the journal under key: stage "done" and its file records dropped."""
+        with self._durable() as conn:
+            conn.execute("DELETE FROM journal_files WHERE key = ?", (key,))
+            row = conn.execute("SELECT import_id FROM imports WHERE key = ?", (key,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO imports (key, import_id, status, updated_at) VALUES (?, ?, 'done', ?)",
+                         (key, row[0] if row else None, time.time()))
+
+    def is_import_done(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM imports WHERE key = ? AND status = 'done'", (key,)).fetchone()
+        return row is not None
+
+    def expire(self, days):
+        """Drop entries older than the retention window."""
+        cutoff = time.time() - days * 86400
+        with self.lock, self.conn:
+            expired = self.conn.execute("DELETE FROM uploads WHERE updated_at < ?", (cutoff,)).rowcount
+            expired += self.conn.execute("DELETE FROM files WHERE updated_at < ?", (cutoff,)).rowcount
+            expired += self.conn.execute("DELETE FROM edf_index WHERE updated_at < ?", (cutoff,)).rowcount
+            expired += self.conn.execute("DELETE FROM manifest WHERE updated_at < ?", (cutoff,)).rowcount
+        return expired
 
 # --- Improved Email Report ---
-def build_email_report(success_log, error_log, missing_files=None, skipped_files=None):
-    with open(success_log, "r") as f:
-        success_content = f.read()
-    with open(error_log, "r") as f:
-        error_content = f.read()
+def build_email_report(report, missing_files=None, skipped_files=None):
+    """Email body for the current run, built from the in-memory run report."""
+    success_content = report.text("SUCCESS")
+    error_content = report.text("ERROR")
     body = "FlashAir & SleepHQ Upload Report\n\n"
     if missing_files:
         body += f"❗ Missing files:\n" + "\n".join(missing_files) + "\n\n"
     if skipped_files:
-        body += f"⏭️ Skipped files (already uploaded):\n" + "\n".join(skipped_files) + "\n\n"
+        body += f"⏭️ Skipped files:\n" + "\n".join(skipped_files) + "\n\n"
     body += "--- SUCCESSFUL OPERATIONS ---\n" + success_content + "\n"
     body += "--- ERRORS ---\n" + error_content + "\n"
     return body
 
+# --- Profiles ---
+class Profile:
+    """One FlashAir card and the SleepHQ/Drive accounts it syncs to.
+
+    Settings left out fall back to the .env values, so Profile() on its own is
+    the classic single-device setup. State files (dedup store, Drive caches,
+    metrics) live in state_dir.
+    """
+
+    SETTINGS = {
+        "flashair_ip": "FLASHAIR_IP",
+        "flashair_password": "FLASHAIR_PASSWORD",
+        "flashair_max_workers": "FLASHAIR_MAX_WORKERS",
+        "download_dir": "DOWNLOAD_DIR",
+        "days_to_keep_flashair": "DAYS_TO_KEEP_FLASHAIR",
+        "days_to_keep_local": "DAYS_TO_KEEP_LOCAL",
+        "client_id": "CLIENT_ID",
+        "client_secret": "CLIENT_SECRET",
+        "username": "USERNAME",
+        "password": "PASSWORD",
+        "team_id": "TEAM_ID",
+        "credentials_json": "CREDENTIALS_JSON",
+        "drive_folder_id": "DRIVE_FOLDER_ID",
+        "notification_email": "NOTIFICATION_EMAIL",
+    }
+
+    def __init__(self, name="default", state_dir=None, **settings):
+        unknown = set(settings) - set(self.SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown settings in profile {name}: {', '.join(sorted(unknown))}")
+        self.name = name
+        for key, global_name in self.SETTINGS.items():
+            setattr(self, key, settings.get(key, globals()[global_name]))
+        missing = [key for key in ("flashair_ip", "download_dir", "team_id", "drive_folder_id")
+                   if not getattr(self, key)]
+        if missing:
+            raise ValueError(f"Profile {name} is missing {', '.join(missing)}")
+        self.state_dir = Path(state_dir or LOG_DIR)
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.last_run = None
+
+    def state_file(self, default_path):
+        """This profile's copy of a state file (same name as the single-device one)."""
+        return self.state_dir / Path(default_path).name
+
+    @property
+    def sleephq_account(self):
+        return (self.client_id, self.username, self.team_id)
+
+    def flashair_client(self):
+        return FlashAirClient(self.flashair_ip, self.flashair_password, self.flashair_max_workers)
+
+    def notify(self, subject, body):
+        """Email this profile's recipient; other profiles' subjects are tagged with the profile name."""
+        if self.name != "default":
+            subject = f"[{self.name}] {subject}"
+        send_email_notification(subject, body, recipient=self.notification_email)
+
+    def dedup_store(self):
+        legacy_log = UPLOAD_LOG_FILE if self.state_dir == Path(LOG_DIR) else None
+        return DedupStore(self.state_file(DEDUP_DB_FILE), legacy_log=legacy_log,
+                          legacy_manifest=self.state_file(SYNC_MANIFEST_FILE))
+
+    def sleephq_client(self, session=None):
+        return SleepHQClient(self.team_id, client_id=self.client_id, client_secret=self.client_secret,
+                             username=self.username, password=self.password, session=session,
+                             token_file=self.state_file(SLEEPHQ_TOKEN_FILE) if SLEEPHQ_TOKEN_CACHE else None)
+
+    def drive_backend(self):
+        return DriveBackend(
+            credentials_json=self.credentials_json,
+            root_folder_id=self.drive_folder_id,
+            folder_cache_file=self.state_file(DRIVE_FOLDER_CACHE_FILE) if DRIVE_PERSIST_FOLDER_CACHE else None,
+            resume_state_file=self.state_file(DRIVE_RESUME_STATE_FILE),
+        )
+
+def load_profiles(profiles_file):
+    """Read a JSON list of profiles (or {"profiles": [...]}).
+
+    Each profile needs a unique "name". Its state goes to LOG_DIR/profiles/<name>
+    and its downloads to DOWNLOAD_DIR/<name> unless state_dir/download_dir are set.
+    """
+    with open(profiles_file) as f:
+        data = json.load(f)
+    entries = data["profiles"] if isinstance(data, dict) else data
+    profiles = []
+    for entry in entries:
+        entry = dict(entry)
+        name = entry.pop("name")
+        if any(profile.name == name for profile in profiles):
+            raise ValueError(f"Duplicate profile name: {name}")
+        state_dir = entry.pop("state_dir", Path(LOG_DIR) / "profiles" / name)
+        if "download_dir" not in entry and DOWNLOAD_DIR:
+            entry["download_dir"] = str(Path(DOWNLOAD_DIR) / name)
+        profiles.append(Profile(name, state_dir, **entry))
+    return profiles
+
+# --- Sync Pipeline ---
+PIPELINE_QUEUE_SIZE = 256
+PIPELINE_DONE = object()  # End-of-stream marker passed down each queue
+CLIENTS_LOCK = threading.Lock()  # Guards creation of SleepHQ/Drive clients shared between pipelines
+
+def start_stage(name, inbox, handle, workers, abort):
+    """Start worker threads that call handle(item) for each queued item.
+
+    Workers stop at PIPELINE_DONE (re-queued so sibling workers see it too).
+    After an abort they keep draining without working, so upstream stages
+    never block on a full queue.
+    """
+    def worker():
+        while True:
+            item = inbox.get()
+            if item is PIPELINE_DONE:
+                inbox.put(PIPELINE_DONE)
+                return
+            if not abort.is_set():
+                handle(item)
+    threads = [threading.Thread(target=in_current_context(worker), name=f"{name}-{i}", daemon=True)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+class SyncPipeline:
+    """FlashAir fetch -> hash/dedup -> SleepHQ and Drive uploads, overlapped through bounded queues.
+
+    With a journal_key the run is journalled in the dedup store so a rerun resumes it.
+    """
+
+    def __init__(self, flashair, store, profile, date_folder, clients=None, journal_key=None):
+        self.flashair = flashair
+        self.clients = clients if clients is not None else {}  # Warm SleepHQ/Drive clients, filled lazily
+        self.store = store
+        self.profile = profile
+        self.download_dir = Path(profile.download_dir)
+        self.date_folder = date_folder
+        self.hash_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.sleephq_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.drive_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.abort = threading.Event()
+        self.failures = []
+        self.missing_files = []
+        self.skipped_files = []  # "path (reason)" for files not sent to SleepHQ
+        self.held = []  # SETTINGS/critical files waiting for a new DATALOG file
+        self.incomplete_files = []  # EDF files still being written, left for a later run
+        self.sessions = {}  # DATALOG session -> its files hashed so far
+        self.nights = set()  # Therapy nights of the EDF files seen, for the index summary
+        self.upload_items = []
+        self.hashed_items = []  # Every file hashed this run, for the per-night Drive archives
+        self.new_datalog_seen = False
+        self.sleephq = self.clients.get("sleephq")
+        self.journal_key = journal_key
+        self.import_id = None
+        self.resumed = False  # import_id was reattached from the journal rather than created by this run
+        self.imported = set()  # Hashes already sent to the reattached import
+        self.drive_sent = set()  # Hashes the interrupted run already backed up to Drive
+        if journal_key:
+            self._resume_journal()
+        self.sleephq_results = {}
+        self.drive = self.clients.get("drive")
+        self.drive_results = {}
+        self.archive_mode = DRIVE_BACKUP_MODE == "archive"  # Drive gets one archive after the run instead
+        self._sleephq_lock = threading.Lock()
+        self._drive_lock = threading.Lock()
+
+    def _resume_journal(self):
+        import_id, stage, reopens = self.store.journal(self.journal_key)
+        if stage == "open" and reopens >= IMPORT_MAX_REOPENS:
+            log_success(f"SleepHQ import {import_id} failed processing {reopens} times; starting a fresh import")
+            self.store.abandon_import(self.journal_key)
+        elif stage == "processing":
+            # The last run died after asking SleepHQ to process its import: that import is closed
+            sent = self.store.journal_hashes(self.journal_key, "sleephq")
+            for file_hash in sent:
+                self.store.mark(file_hash, "sleephq")
+            self.store.finish_import(self.journal_key)
+            log_success(f"Closed SleepHQ import {import_id} left processing by an interrupted run ({len(sent)} files)")
+        elif stage == "open":
+            self.import_id = import_id
+            self.resumed = True
+            self.imported = self.store.journal_hashes(self.journal_key, "sleephq")
+            self.drive_sent = self.store.journal_hashes(self.journal_key, "drive")
+            log_success(f"Resuming interrupted run: SleepHQ import {import_id} "
+                        f"({len(self.imported)} files already sent, {len(self.drive_sent)} on Drive)")
+
+    def run(self, required_files, remote_entries, always_upload):
+        """Run every stage to completion; required_files are fetched in the given order."""
+        self.always_upload = set(always_upload)
+        self.required_files = required_files
+        self.session_sizes = {}
+        for remote_file in required_files:
+            session = self._session_key(remote_file)
+            if session:
+                self.session_sizes[session] = self.session_sizes.get(session, 0) + 1
+        self.remote_entries = remote_entries
+        threads = [threading.Thread(target=in_current_context(self._hash_stage), name="hash", daemon=True)]
+        threads[0].start()
+        threads += start_stage("sleephq", self.sleephq_queue, self._upload_sleephq, SLEEPHQ_MAX_WORKERS, self.abort)
+        if not self.archive_mode:
+            threads += start_stage("drive", self.drive_queue, self._upload_drive, DRIVE_MAX_WORKERS, self.abort)
+        self._fetch_stage(required_files, remote_entries)
+        for thread in threads:
+            thread.join()
+        return self
+
+    def _fail(self, stage, item, error):
+        log_error(f"{stage} failed for {item['remote']}: {error}", step=stage, file=item["remote"])
+        self.failures.append(error)
+        self.abort.set()
+
+    def _fetch_stage(self, required_files, remote_entries):
+        try:
+            to_download = {}
+            for remote_file in required_files:
+                item = {"remote": remote_file, "local": self.download_dir / remote_file.lstrip("/"), "hash": None}
+                known = self.store.downloaded(remote_file)
+                if is_unchanged_on_flashair(remote_entries.get(remote_file), known, item["local"]):
+                    log_success(f"Unchanged on FlashAir, skipping download: {remote_file}")
+                    item["hash"] = known["sha256"]
+                    self.hash_queue.put(item)
+                else:
+                    to_download[remote_file] = item
+            downloads = [
+                (item["remote"], item["local"]) + self._grown_file_prefix(item, remote_entries.get(item["remote"]))
+                for item in to_download.values()
+            ]
+            for remote_file, local_path, file_hash in self.flashair.download_many(downloads):
+                item = to_download[remote_file]
+                entry = remote_entries.get(remote_file)
+                if file_hash:
+                    item["hash"] = file_hash
+                    if entry is not None:
+                        # Recorded as each download lands, so a killed run doesn't fetch it again
+                        self.store.remember_download(remote_file, entry, file_hash)
+                if not local_path.exists():
+                    # Any missing required file fails the run before it is processed
+                    self.missing_files.append(str(local_path))
+                    self.abort.set()
+                elif not self.abort.is_set():
+                    self.hash_queue.put(item)
+        except Exception as e:
+            self._fail("Download", {"remote": "FlashAir"}, e)
+        finally:
+            self.hash_queue.put(PIPELINE_DONE)
+
+    def _grown_file_prefix(self, item, entry):
+        """(held_size, header_size) when only the tail of a grown DATALOG file needs fetching, else ().
+
+        The file must have grown on the card since it was last downloaded and
+        the local copy must still hash to what was downloaded then.
+        """
+        known = self.store.downloaded(item["remote"])
+        if not FLASHAIR_TAIL_FETCH or entry is None or not known or "/DATALOG/" not in item["remote"]:
+            return ()
+        if entry["size"] <= known["size"] or not item["local"].exists():
+            return ()
+        if item["local"].stat().st_size != known["size"] or self.store.hash_for(item["local"]) != known.get("sha256"):
+            return ()
+        header = edf_header(item["local"]) if item["remote"].lower().endswith(".edf") else None
+        return (known["size"], header["header_bytes"] if header else 0)
+
+    def _still_being_written(self, item):
+        """True for a DATALOG EDF file the CPAP is still writing (recently modified and incomplete)."""
+        if not item["remote"].lower().endswith(".edf") or not edf_is_incomplete(item["local"], item.get("edf")):
+            return False
+        entry = self.remote_entries.get(item["remote"])
+        modified = fat_datetime(entry["date"], entry["time"]) if entry else None
+        return modified is not None and datetime.now() - modified < timedelta(hours=EDF_HOLD_MAX_HOURS)
+
+    def _hash_stage(self):
+        try:
+            while True:
+                item = self.hash_queue.get()
+                if item is PIPELINE_DONE:
+                    break
+                if self.abort.is_set():
+                    continue
+                try:
+                    self._dedup(item)
+                except Exception as e:
+                    self._fail("Hash", item, e)
+            if not self.abort.is_set():
+                for session in list(self.sessions):
+                    # Only left over if a file was listed twice; decide with what arrived
+                    self._select_session(session, self.sessions.pop(session))
+                for night in sorted(self.nights):
+                    sessions, files, seconds = self.store.night_summary(night)
+                    log_success(f"Therapy night {night}: {sessions} sessions, {seconds / 3600:.1f} h recorded "
+                                f"in {files} EDF files", step="Index")
+                # Nights with nothing new are synced already; the rest wait for process()
+                self._record_nights(lambda item: False)
+        except Exception as e:
+            self._fail("Hash", {"remote": "EDF index"}, e)
+        finally:
+            self.sleephq_queue.put(PIPELINE_DONE)
+            self.drive_queue.put(PIPELINE_DONE)
+
+    def _dedup(self, item):
+        if item["hash"]:
+            self.store.remember_hash(item["local"], item["hash"])
+        else:
+            item["hash"] = self.store.hash_for(item["local"])
+        item["relative"] = item["local"].relative_to(self.download_dir)
+        self.hashed_items.append(item)
+        session = self._session_key(item["remote"])
+        if session is None:
+            self._select(item)
+            return
+        items = self.sessions.setdefault(session, [])
+        items.append(item)
+        if len(items) == self.session_sizes.get(session, 1):
+            self._select_session(session, self.sessions.pop(session))
+
+    @staticmethod
+    def _night_folder(remote_file):
+        """YYYYMMDD of the DATALOG folder holding remote_file, None for files outside one."""
+        parts = remote_file.split("/")
+        return parts[2] if len(parts) > 3 and parts[1] == "DATALOG" else None
+
+    def _record_nights(self, confirmed):
+        """Mark each DATALOG night folder seen with nothing left to send as synced:<night>.
+
+        confirmed(item) says whether a file released for SleepHQ got there. The
+        marker outlives the upload hashes, so backfill never re-imports the night.
+        """
+        nights = {self._night_folder(item["remote"]) for item in self.hashed_items} - {None}
+        pending = {Path(path).parent.name for path in self.incomplete_files}
+        pending |= {self._night_folder(item["remote"]) for item in self.upload_items if not confirmed(item)}
+        for night in nights:
+            if night in pending:
+                self.store.abandon_import(f"synced:{night}")
+            else:
+                self.store.finish_import(f"synced:{night}")
+
+    @staticmethod
+    def _session_key(remote_file):
+        """Session of a DATALOG EDF file, None for anything else."""
+        if "/DATALOG/" not in remote_file or not remote_file.lower().endswith(".edf"):
+            return None
+        return edf_session(remote_file)
+
+    def _select_session(self, session, items):
+        """Release a whole DATALOG session once none of its files is still being written; skip empty files."""
+        for item in items:
+            item["edf"] = self.store.edf_info(item["local"], item["remote"].split("/")[2])
+            if item["edf"]:
+                self.nights.add(item["edf"]["night"])
+        writing = [item["remote"] for item in items if self._still_being_written(item)]
+        if writing:
+            # Uploading now would only be superseded by the finished files
+            log_success(f"Holding back session {session} until its EDF files are finished: {', '.join(writing)}",
+                        step="Dedup", file=writing[0])
+            self.incomplete_files += [str(item["local"]) for item in items]
+            return
+        for item in items:
+            if edf_is_empty(item["local"], item["edf"]):
+                self._skip(item, "EDF file has no data records")
+            else:
+                self._select(item)
+
+    def _select(self, item):
+        if not self.archive_mode and not self.store.is_uploaded(item["hash"], "drive"):
+            # Decided apart from SleepHQ, so a file only Drive is missing still gets backed up
+            self.drive_queue.put(item)
+        is_datalog = "/DATALOG/" in item["remote"]
+        if is_datalog and not self.store.is_uploaded(item["hash"], "sleephq"):
+            if not self.new_datalog_seen:
+                self.new_datalog_seen = True
+                for held_item in self.held:
+                    self._release(held_item)
+                self.held = []
+            self._release(item)
+        elif item["remote"] in self.always_upload:
+            if SLEEPHQ_SKIP_UNCHANGED and self.store.is_uploaded(item["hash"], "sleephq"):
+                # Same bytes as a confirmed upload: SleepHQ doesn't need it again
+                item["sleephq_skip"] = "unchanged since its last confirmed SleepHQ upload"
+            if self.new_datalog_seen:
+                self._release(item)
+            else:
+                self.held.append(item)
+        else:
+            self._skip(item, "already uploaded to SleepHQ")
+
+    def _skip(self, item, reason):
+        log_success(f"Not sending to SleepHQ, {reason}: {item['remote']}", step="Dedup", file=item["remote"])
+        self.skipped_files.append(f"{item['local']} ({reason})")
+
+    def _release(self, item):
+        self.upload_items.append(item)
+        if item.get("sleephq_skip"):
+            self._skip(item, item["sleephq_skip"])
+            # Counts as confirmed, so process() refreshes its record and it never ages out while unchanged
+            self.sleephq_results[item["local"]] = True
+        else:
+            self.sleephq_queue.put(item)
+
+    def _client(self, name, factory):
+        """The shared client called name, created on first use (pipelines may share one clients dict)."""
+        with CLIENTS_LOCK:
+            if self.clients.get(name) is None:
+                self.clients[name] = factory()
+            return self.clients[name]
+
+    def _ensure_import(self):
+        with self._sleephq_lock:
+            if self.sleephq is None:
+                self.sleephq = self._client("sleephq", self.profile.sleephq_client)
+            if self.import_id is None:
+                self.import_id = self.sleephq.create_import()
+                if self.journal_key:
+                    self.store.begin_import(self.journal_key, self.import_id)
+            return self.import_id
+
+    def _drop_import(self, import_id):
+        """Forget an import SleepHQ rejected; True if it was reattached and a fresh import should be tried."""
+        with self._sleephq_lock:
+            if self.import_id != import_id:
+                return True  # Another worker already dropped it
+            if self.journal_key:
+                self.store.abandon_import(self.journal_key)
+            if not self.resumed:
+                return False
+            log_success(f"SleepHQ no longer accepts reattached import {import_id}; starting a fresh import")
+            self.import_id = None
+            self.resumed = False
+            self.imported = set()
+            return True
+
+    def _send_sleephq(self, item):
+        """Send item to the current import; ImportRejected if SleepHQ refuses the import itself."""
+        import_id = self._ensure_import()
+        if item["hash"] in self.imported:
+            log_success(f"Already sent to import {import_id}, skipping: {item['local']}", file=str(item["relative"]))
+            ok = True
+        else:
+            ok = self.sleephq.upload_file(import_id, item["local"], item["relative"], item["hash"])
+            if ok and self.journal_key:
+                self.store.record_sent(self.journal_key, "sleephq", item["hash"], item["relative"])
+        item["import_id"] = import_id
+        self.sleephq_results[item["local"]] = ok
+
+    def _upload_sleephq(self, item):
+        while True:
+            try:
+                self._send_sleephq(item)
+                return
+            except ImportRejected as e:
+                if not self._drop_import(e.import_id):
+                    self._fail("SleepHQ", item, e)
+                    return
+            except Exception as e:
+                self._fail("SleepHQ", item, e)
+                return
+
+    def _ensure_drive(self):
+        with self._drive_lock:
+            if self.drive is None:
+                self.drive = self._client("drive", self.profile.drive_backend)
+            return self.drive
+
+    def _upload_drive(self, item):
+        if item["hash"] in self.drive_sent:
+            log_success(f"Already backed up to Drive by the interrupted run, skipping: {item['local']}",
+                        file=str(item["relative"]))
+            self.drive_results[item["local"]] = True
+            return
+        try:
+            drive = self._ensure_drive()
+        except Exception as e:
+            self._fail("Drive", item, e)
+            return
+        with current_metrics().span("drive_upload") as span:
+            ok = drive.upload(item["local"], self.date_folder)
+            if ok:
+                span["bytes"] = os.path.getsize(item["local"])
+            else:
+                span["error"] = "UploadFailed"
+        self.drive_results[item["local"]] = ok
+        self.store.mark(item["hash"], "drive", status="uploaded" if ok else "failed", path=item["relative"])
+        if ok and self.journal_key:
+            self.store.record_sent(self.journal_key, "drive", item["hash"], item["relative"])
+
+    def upload_archive(self):
+        """Archive mode: back up each DATALOG night folder as one object, <night>.tar.* in its date folder.
+
+        A night's archive is rebuilt, replacing the previous one, only when one
+        of its files isn't confirmed on Drive yet. SETTINGS and critical files
+        go into a small <date>.settings.tar.* of their own in the same way.
+        """
+        try:
+            drive = self._ensure_drive()
+        except Exception as e:
+            log_error(f"Drive archive upload failed: {e}", step="Drive")
+            return False
+        groups = {}
+        for item in self.hashed_items:
+            name = self._night_folder(item["remote"]) or f"{self.date_folder}.settings"
+            groups.setdefault(name, []).append(item)
+        ok = True
+        for name, items in sorted(groups.items()):
+            if all(self.store.is_uploaded(item["hash"], "drive") for item in items):
+                for item in items:
+                    self.drive_results[item["local"]] = True
+                continue
+            ok = self._upload_archive(drive, name, items) and ok
+        return ok
+
+    def _upload_archive(self, drive, name, items):
+        """Pack items into <name>.tar.* and replace the one in Drive folder <name> up to the first dot."""
+        archive_path = self.download_dir / "archives" / f"{name}{ARCHIVE_SUFFIXES[DRIVE_ARCHIVE_COMPRESSION]}"
+        files = sorted((item["remote"].lstrip("/"), item["local"]) for item in items)
+        with current_metrics().span("drive_archive") as span:
+            try:
+                write_archive(files, archive_path, DRIVE_ARCHIVE_COMPRESSION)
+                log_success(f"Packed {len(files)} files into {archive_path.name}", step="Drive")
+            except Exception as e:
+                span["error"] = type(e).__name__
+                log_error(f"Failed to build Drive archive {archive_path}: {e}", step="Drive")
+                return False
+            span["bytes"] = os.path.getsize(archive_path)
+            ok = drive.upload(archive_path, name.split(".", 1)[0], replace=True)
+            if not ok:
+                span["error"] = "UploadFailed"
+        for item in items:
+            self.drive_results[item["local"]] = ok
+            self.store.mark(item["hash"], "drive", status="uploaded" if ok else "failed", path=item["relative"])
+        if ok:
+            os.remove(archive_path)
+        return ok
+
+    def process(self):
+        """Process the SleepHQ import, record each file's outcome and close the journal.
+
+        The journal stage is "processing" while the request is in flight; if it
+        fails the import is reopened so the next run processes it again, up to
+        IMPORT_MAX_REOPENS times. If SleepHQ rejects a reattached import, its
+        files go to a fresh one instead. Returns False if processing failed.
+        """
+        if self.import_id is None:
+            if self.journal_key:
+                self.store.finish_import(self.journal_key)
+            self._record_nights(lambda item: self.sleephq_results.get(item["local"]))
+            return True
+        processed = rejected = False
+        while True:
+            try:
+                import_id = self._ensure_import()
+                # Files confirmed by an import dropped mid-run go to the current one too
+                for item in self.upload_items:
+                    if self.sleephq_results.get(item["local"]) and item.get("import_id", import_id) != import_id:
+                        self._send_sleephq(item)
+                if self.journal_key:
+                    self.store.set_import_stage(self.journal_key, "processing")
+                processed = self.sleephq.process_import(import_id)
+                break
+            except ImportRejected as e:
+                if not self._drop_import(e.import_id):
+                    log_error(str(e))
+                    rejected = True
+                    break
+            except Exception as e:
+                log_error(f"Failed to process SleepHQ import: {e}")
+                break
+        # Hashes count as uploaded to SleepHQ only once the import has been processed
+        for item in self.upload_items:
+            ok = processed and self.sleephq_results.get(item["local"])
+            self.store.mark(item["hash"], "sleephq", status="uploaded" if ok else "failed", path=item["relative"])
+        if self.journal_key and not rejected:
+            if processed:
+                self.store.finish_import(self.journal_key)
+            else:
+                self.store.reopen_import(self.journal_key)
+        self._record_nights(lambda item: processed and self.sleephq_results.get(item["local"]))
+        return processed
+
 # --- Main Script ---
-if __name__ == "__main__":
+SYNC_JOURNAL_KEY = "sync"  # Journal key of the normal today/yesterday sync
+CRITICAL_FILES = [
+    "/STR.edf",
+    "/Identification.crc",
+    "/Identification.json"
+]
+
+def datalog_folders_to_sync():
+    today_str = datetime.now().strftime("%Y%m%d")
+    yesterday_str = (datetime.now() - timedelta(days=1)).strftime("%Y%m%d")
+    return [f"/DATALOG/{today_str}", f"/DATALOG/{yesterday_str}"]
+
+def run_sync(flashair, store, clients=None, cleanup=True, notify_skipped=True, profile=None):
+    """Run one FlashAir -> SleepHQ/Drive sync and return the process exit code.
+
+    clients holds SleepHQ/Drive clients that are reused across calls (watch
+    mode keeps them warm). Skip notifications can be silenced for the same
+    reason, since a watch cycle that finds nothing new is routine. Stage
+    metrics are emitted at the end of every run, whatever its outcome. The
+    finished RunContext is left on profile.last_run.
+    """
+    profile = profile or Profile()
+    return in_run(profile, lambda report: _run_sync(flashair, store, clients, cleanup, notify_skipped, profile,
+                                                    report))
+
+def in_run(profile, body):
+    """Call body(report) as one run of profile and return its exit code; metrics are emitted whatever happens."""
+    run = profile.last_run = RunContext(profile.name)
+    token = CURRENT_RUN.set(run)
+    exit_code = 1
+    try:
+        exit_code = body(run.report)
+        return exit_code
+    finally:
+        try:
+            run.metrics.emit(exit_code, profile.state_file(METRICS_JSON_FILE), metrics_textfile(profile))
+        except Exception as e:
+            log_error(f"Failed to write run metrics: {e}")
+        CURRENT_RUN.reset(token)
+        flush_logs()
+
+def metrics_textfile(profile):
+    """METRICS_TEXTFILE for the default profile; a per-profile file beside it for the others."""
+    if profile.name == "default":
+        return METRICS_TEXTFILE
+    return METRICS_TEXTFILE.with_name(f"{METRICS_TEXTFILE.stem}_{profile.name}{METRICS_TEXTFILE.suffix}")
+
+def _run_sync(flashair, store, clients, cleanup, notify_skipped, profile, report):
+    notify = profile.notify
+    outages = flashair.health.outages
     try:
         # Step 1: Gather required files (today/yesterday's DATALOG, all SETTINGS, critical files)
         today_str = datetime.now().strftime("%Y%m%d")
-        yesterday_str = (datetime.now() - timedelta(days=1)).strftime("%Y%m%d")
-        required_files = []
+        datalog_files = []
+        remote_entries = {}
 
-        # DATALOG folders
-        for datalog_folder in [f"/DATALOG/{today_str}", f"/DATALOG/{yesterday_str}"]:
-            try:
-                required_files.extend(list_flashair_files(datalog_folder))
-            except Exception as e:
-                log_error(f"Failed to list {datalog_folder}: {e}")
-
-        # SETTINGS folder (all files)
+        # DATALOG and SETTINGS folders (all files), listed in parallel
         try:
-            settings_files = list_flashair_files("/SETTINGS")
-            required_files.extend(settings_files)
+            settings_files = []
+            for entry in flashair.list_entries(datalog_folders_to_sync() + ["/SETTINGS"]):
+                remote_entries[entry["path"]] = entry
+                if entry["path"].startswith("/SETTINGS/"):
+                    settings_files.append(entry["path"])
+                else:
+                    datalog_files.append(entry["path"])
         except Exception as e:
             log_error(f"Failed to list /SETTINGS: {e}")
-            send_email_notification(
+            notify(
                 "🚨 FlashAir and SleepHQ Upload Failed",
                 "Critical failure: Unable to retrieve SETTINGS folder."
             )
-            sys.exit(1)
+            return 1
 
         # Critical standalone files
-        critical_files = [
-            "/STR.edf",
-            "/Identification.crc",
-            "/Identification.json"
-        ]
-        required_files.extend(critical_files)
-
-        # Step 2: Download required files
-        missing_files = []
-        for remote_file in required_files:
-            relative_path = remote_file.lstrip("/")
-            local_path = Path(DOWNLOAD_DIR) / relative_path
-            flashair_download_file(remote_file, local_path)  # Always overwrite
-            if not local_path.exists():
-                missing_files.append(str(local_path))
-
-        # Step 3: Validate required files
-        missing = []
-        for critical in critical_files:
-            if not (Path(DOWNLOAD_DIR) / critical.lstrip("/")).exists():
-                missing.append(critical)
-        for settings_file in settings_files:
-            if not (Path(DOWNLOAD_DIR) / settings_file.lstrip("/")).exists():
-                missing.append(settings_file)
-        if missing:
-            log_error(f"Missing required files after download: {', '.join(missing)}")
-            send_email_notification(
-                "🚨 FlashAir and SleepHQ Upload Failed",
-                f"Missing required files after download: {', '.join(missing)}"
-            )
-            sys.exit(1)
+        critical_files = list(CRITICAL_FILES)
+        for entry in flashair.list_entries("/", recursive=False):
+            if entry["path"] in critical_files:
+                remote_entries[entry["path"]] = entry
 
-        # Step 4: Check hash log for duplicates
-        uploaded_hashes = load_hash_log(UPLOAD_LOG_FILE)
-        files_to_upload = []
-        skipped_files = []
-        new_datalog_files = []
+        # Steps 2-5: Download new or changed files, check the dedup store, and upload
+        # to SleepHQ and Google Drive as an overlapped pipeline. Critical and SETTINGS
+        # files go first so a missing one aborts the run before DATALOG uploads pile up.
+        store.expire(HASH_RETENTION_DAYS)
+        pipeline = SyncPipeline(flashair, store, profile, today_str, clients=clients,
+                                journal_key=SYNC_JOURNAL_KEY)
+        pipeline.run(critical_files + settings_files + datalog_files, remote_entries,
+                     always_upload=critical_files + settings_files)
+        skipped_files = pipeline.skipped_files
+        profile.last_run.incomplete_files = pipeline.incomplete_files
 
-        for file_path in required_files:
-            local_path = Path(DOWNLOAD_DIR) / file_path.lstrip("/")
-            if not local_path.exists():
-                continue
-            file_hash = sha256_of_file(local_path)
-            is_datalog = "/DATALOG/" in file_path
-            if file_hash not in uploaded_hashes or file_path in critical_files or file_path in settings_files:
-                files_to_upload.append(local_path)
-                if is_datalog and file_hash not in uploaded_hashes:
-                    new_datalog_files.append(local_path)
-            else:
-                skipped_files.append(str(local_path))
+        if pipeline.missing_files and flashair.health.outages > outages:
+            # A card that dropped off mid-run isn't a failed upload: the journal and
+            # manifest let the next run pick up where this one stopped
+            log_error(f"FlashAir went offline during the sync; {len(pipeline.missing_files)} files were not "
+                      "downloaded and will be fetched on the next run", step="Validation")
+            return 1
 
-        if missing_files:
-            log_error(f"Missing required files after download: {', '.join(missing_files)}", step="Validation")
-            email_body = build_email_report(SUCCESS_LOG, ERROR_LOG, missing_files=missing_files)
-            send_email_notification(
+        if pipeline.missing_files:
+            log_error(f"Missing required files after download: {', '.join(pipeline.missing_files)}", step="Validation")
+            email_body = build_email_report(report, missing_files=pipeline.missing_files)
+            notify(
                 "🚨 FlashAir and SleepHQ Upload Failed",
                 email_body
             )
-            sys.exit(1)
+            return 1
 
-        if not files_to_upload:
-            log_success("All files for today and yesterday have already been uploaded.", step="Validation")
-            email_body = build_email_report(SUCCESS_LOG, ERROR_LOG, skipped_files=skipped_files)
-            send_email_notification(
-                "✅ FlashAir and SleepHQ Upload Skipped",
+        if pipeline.failures:
+            log_error(f"Failed during upload: {pipeline.failures[0]}", step="Upload")
+            email_body = build_email_report(report)
+            notify(
+                "🚨 FlashAir and SleepHQ Upload Failed",
                 email_body
             )
-            sys.exit(0)
+            return 1
+
+        if pipeline.archive_mode:
+            # Decided apart from SleepHQ: nights whose archive isn't confirmed on Drive yet
+            pipeline.upload_archive()
+
+        if not pipeline.upload_items and not pipeline.held:
+            log_success("All files for today and yesterday have already been uploaded.", step="Validation")
+            if notify_skipped:
+                email_body = build_email_report(report, skipped_files=skipped_files)
+                notify(
+                    "✅ FlashAir and SleepHQ Upload Skipped",
+                    email_body
+                )
+            return 0
 
         # --- Only proceed if there is a new DATALOG file to upload ---
-        if not new_datalog_files:
+        if not pipeline.new_datalog_seen:
             log_success("No new DATALOG files to upload. Skipping upload.", step="Validation")
-            email_body = build_email_report(SUCCESS_LOG, ERROR_LOG, skipped_files=skipped_files)
-            send_email_notification(
-                "✅ FlashAir and SleepHQ Upload Skipped (No New DATALOG)",
-                email_body
-            )
-            sys.exit(0)
-
-        # Step 5: Upload to SleepHQ and Google Drive
-        try:
-            access_token = get_access_token()
-            import_id = create_import(access_token)
-            gauth = GoogleAuth(settings={
-                "client_config_backend": "service",
-                "service_config": {
-                    "client_json_file_path": CREDENTIALS_JSON
-                }
-            })
-            gauth.ServiceAuth()
-            drive = GoogleDrive(gauth)
-            for file_path in files_to_upload:
-                relative_path = file_path.relative_to(DOWNLOAD_DIR)
-                if upload_file_to_import(file_path, access_token, import_id, relative_path):
-                    log_hash(sha256_of_file(file_path), UPLOAD_LOG_FILE)
-            # Determine the date folder for each file (e.g., based on today's date or file's parent folder)
-            for file_path in files_to_upload:
-                relative_path = file_path.relative_to(DOWNLOAD_DIR)
-                # Use today's date as folder name, or extract from file_path if you want per-session folders
-                date_folder = today_str
-                upload_to_drive(file_path, date_folder, drive)
-            process_import(access_token, import_id)
-        except Exception as e:
-            log_error(f"Failed during upload: {e}", step="Upload")
-            email_body = build_email_report(SUCCESS_LOG, ERROR_LOG)
-            send_email_notification(
-                "🚨 FlashAir and SleepHQ Upload Failed",
-                email_body
-            )
-            sys.exit(1)
+            if notify_skipped:
+                email_body = build_email_report(report, skipped_files=skipped_files)
+                notify(
+                    "✅ FlashAir and SleepHQ Upload Skipped (No New DATALOG)",
+                    email_body
+                )
+            return 0
 
-        # Step 6: Cleanup
-        cleanup_local_files(DOWNLOAD_DIR, days_old=DAYS_TO_KEEP_LOCAL)
-        cleanup_flashair_dated_folders("/DATALOG", days_old=DAYS_TO_KEEP_FLASHAIR)
-        cleanup_drive_dated_folders(days_old=DAYS_TO_KEEP_FLASHAIR)
+        processed = pipeline.process()
 
-        # Step 7: Concise Email Notification
-        with open(ERROR_LOG, "r") as error_file:
-            error_content = error_file.read().strip()
+        # Step 6: Concise Email Notification
+        error_content = report.text("ERROR")
 
-        if error_content:
+        if not processed:
+            email_body = build_email_report(report)
+            subject = "🚨 FlashAir and SleepHQ Upload Failed"
+        elif error_content:
             email_body = (
                 "Some errors occurred during the FlashAir & SleepHQ upload process:\n\n"
                 f"{error_content}\n"
@@ -564,20 +2906,384 @@ if __name__ == "__main__":
             email_body = "✅ FlashAir and SleepHQ upload completed successfully. All required files were uploaded."
             subject = "✅ FlashAir and SleepHQ Upload Success"
 
-        send_email_notification(subject, email_body)
+        # Step 7: Cleanup, alongside the email (its results go to the log and run metrics)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="retention") as executor:
+            retention = None
+            if cleanup:
+                retention = executor.submit(in_current_context(run_retention), flashair, profile, pipeline.clients)
+            notify(subject, email_body)
+        if retention is not None and retention.exception() is not None:
+            log_error(f"Retention cleanup failed: {retention.exception()}", step="Cleanup")
+        if not processed:
+            return 1
         print("🎉 All operations completed successfully!")
-        sys.exit(0)
+        return 0
 
     except Exception as e:
         log_error(f"Critical Failure: {e}", step="Critical")
-        with open(ERROR_LOG, "r") as error_file:
-            error_content = error_file.read().strip()
+        error_content = report.text("ERROR")
         email_body = (
             "A critical error occurred during the FlashAir & SleepHQ upload process:\n\n"
             f"{error_content}\n"
         )
-        send_email_notification(
+        notify(
             "🚨 FlashAir and SleepHQ Upload Failed",
             email_body
         )
-        sys.exit(1)
\ No newline at end of file
+        return 1
+
+def run_retention(flashair, profile, clients, dry_run=False):
+    """Apply the retention policy to the local copy, the card and Drive; returns {store: totals}.
+
+    Reuses (or creates and keeps) the run's Drive client. With dry_run nothing
+    is deleted and the totals are what would be.
+    """
+    report = {}
+    with current_metrics().span("cleanup_local") as span:
+        report["local"] = prune_local(profile.download_dir, profile.days_to_keep_local, dry_run)
+        span["bytes"] = report["local"]["bytes"]
+    with current_metrics().span("cleanup_flashair") as span:
+        report["flashair"] = prune_flashair(flashair, "/DATALOG", profile.days_to_keep_flashair, dry_run)
+        span["bytes"] = report["flashair"]["bytes"]
+    with current_metrics().span("cleanup_drive") as span:
+        try:
+            if clients.get("drive") is None:
+                clients["drive"] = profile.drive_backend()
+        except Exception as e:
+            log_error(f"Failed to clean up old folders in Google Drive: {e}")
+            report["drive"] = {"folders": 0, "files": 0, "bytes": 0}
+        else:
+            report["drive"] = prune_drive(clients["drive"], profile.days_to_keep_flashair, dry_run)
+        span["bytes"] = report["drive"]["bytes"]
+    verb = "Would delete" if dry_run else "Deleted"
+    for store_name, totals in report.items():
+        log_success(f"{verb} {totals['folders']} dated folders, {totals['files']} files, "
+                    f"{totals['bytes'] / 1e6:.1f} MB from {store_name}", step="Retention")
+    return report
+
+# --- Backfill ---
+def run_backfill(flashair, store, clients=None, profile=None, max_parallel=None):
+    """Catch up on every DATALOG night on the card older than yesterday that was never synced.
+
+    Nights go newest first, up to max_parallel at a time, and each night is
+    its own SleepHQ import and Drive date folder. Imports are checkpointed per
+    file in the dedup store, so a crashed backfill resumes where it stopped.
+    Today and yesterday are left to the normal run.
+    """
+    profile = profile or Profile()
+    return in_run(profile, lambda report: _run_backfill(flashair, store, clients if clients is not None else {},
+                                                        profile, report, max_parallel or BACKFILL_MAX_PARALLEL))
+
+def _run_backfill(flashair, store, clients, profile, report, max_parallel):
+    recent = {folder.rsplit("/", 1)[-1] for folder in datalog_folders_to_sync()}
+    try:
+        # list_dir raises on errors, so an unreachable card never looks like nothing to do
+        folders = [entry["path"].rsplit("/", 1)[-1] for entry in flashair.list_dir("/DATALOG") if entry["is_dir"]]
+        nights = sorted(
+            (night for night in folders
+             if night not in recent and retention_expired(night, datetime.now())
+             and not store.is_import_done(f"backfill:{night}") and not store.is_import_done(f"synced:{night}")),
+            reverse=True,
+        )
+        if not nights:
+            log_success("No unsynced DATALOG nights to backfill", step="Backfill")
+            return 0
+        log_success(f"Backfilling {len(nights)} nights: {', '.join(nights)}", step="Backfill")
+
+        # SETTINGS and critical files go into every night's import, like a normal run
+        shared_entries = {}
+        for entry in flashair.list_entries(["/SETTINGS"]):
+            shared_entries[entry["path"]] = entry
+        for entry in flashair.list_entries("/", recursive=False):
+            if entry["path"] in CRITICAL_FILES:
+                shared_entries[entry["path"]] = entry
+        shared_files = list(CRITICAL_FILES) + sorted(path for path in shared_entries if path.startswith("/SETTINGS/"))
+        store.expire(HASH_RETENTION_DAYS)
+
+        def backfill_night(night):
+            key = f"backfill:{night}"
+            remote_entries = dict(shared_entries)
+            datalog_files = []
+            for entry in flashair.list_dir(f"/DATALOG/{night}"):
+                if not entry["is_dir"]:
+                    remote_entries[entry["path"]] = entry
+                    datalog_files.append(entry["path"])
+            pipeline = SyncPipeline(flashair, store, profile, night, clients=clients, journal_key=key)
+            pipeline.run(shared_files + sorted(datalog_files), remote_entries, always_upload=shared_files)
+            if pipeline.missing_files or pipeline.failures:
+                log_error(f"Backfill of {night} failed, will resume on the next backfill", step="Backfill")
+                return False
+            unsent = [item for item in pipeline.upload_items if not pipeline.sleephq_results.get(item["local"])]
+            if unsent:
+                # The import stays open; the next backfill reattaches and sends only these
+                log_error(f"Backfill of {night}: {len(unsent)} files not uploaded, import left open", step="Backfill")
+                return False
+            if pipeline.archive_mode:
+                pipeline.upload_archive()
+            if not pipeline.process():
+                return False
+            sent = sum(1 for item in pipeline.upload_items if not item.get("sleephq_skip"))
+            log_success(f"Backfilled {night}: {sent} files uploaded, "
+                        f"{len(pipeline.skipped_files)} skipped", step="Backfill")
+            return True
+
+        def attempt(night):
+            try:
+                return backfill_night(night)
+            except Exception as e:
+                log_error(f"Backfill of {night} failed: {e}", step="Backfill")
+                return False
+
+        # The newest night runs alone first, so the shared files are fetched once
+        # before nights run side by side
+        results = {nights[0]: attempt(nights[0])}
+        with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="backfill") as executor:
+            futures = {executor.submit(in_current_context(attempt), night): night for night in nights[1:]}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        failed = sorted(night for night, ok in results.items() if not ok)
+        done = len(results) - len(failed)
+        if failed:
+            offline = "FlashAir went offline during the backfill.\n" if flashair.health.gave_up else ""
+            profile.notify(
+                "⚠️ FlashAir Backfill Completed With Errors",
+                f"Backfilled {done} of {len(results)} nights. Failed: {', '.join(failed)}\n{offline}\n"
+                f"{report.text('ERROR')}\n",
+            )
+            return 1
+        profile.notify("✅ FlashAir Backfill Complete", f"Backfilled {done} nights: {', '.join(sorted(results))}")
+        return 0
+    except Exception as e:
+        log_error(f"Critical Failure: {e}", step="Critical")
+        profile.notify("🚨 FlashAir Backfill Failed", f"{report.text('ERROR')}\n")
+        return 1
+
+# --- Watch Mode ---
+def flashair_was_updated(flashair):
+    """Ask the card whether its files changed since the last check (op=102).
+
+    Cards that don't support the command are treated as always updated, which
+    falls back to comparing directory listings.
+    """
+    try:
+        return flashair.get({"op": "102"}).strip() != "0"
+    except Exception:
+        return True
+
+def datalog_signature(flashair):
+    """Snapshot of today's/yesterday's DATALOG listing, used to spot new or growing files.
+
+    Raises if the card can't be reached, so an outage never looks like a change.
+    """
+    signature = []
+    for folder in datalog_folders_to_sync():
+        try:
+            entries = flashair.list_dir(folder)
+        except requests.HTTPError:
+            continue  # Folder doesn't exist yet
+        signature.extend((entry["path"], entry["size"], entry["date"], entry["time"]) for entry in entries)
+    return tuple(sorted(signature))
+
+def watch(flashair, store, poll_interval, quiet_period, profile=None, clients=None):
+    """Poll the card and sync once DATALOG files have been stable for quiet_period seconds.
+
+    The FlashAir client, dedup store and SleepHQ/Drive clients stay warm
+    between cycles; cleanup runs at most once a day. A failed sync is retried
+    with backoff (up to WATCH_RETRY_MAX seconds apart) even if the card hasn't
+    changed, and sessions held back as still being written are looked at
+    again after another quiet period.
+    """
+    profile = profile or Profile()
+    clients = clients if clients is not None else {}
+    failures = 0
+
+    def sync(signature, cleanup):
+        """Run one sync; returns (signature now synced, monotonic time of the next forced sync or None)."""
+        nonlocal failures
+        if run_sync(flashair, store, clients=clients, cleanup=cleanup, notify_skipped=False, profile=profile) != 0:
+            failures += 1
+            delay = poll_interval + backoff_delay(failures - 1, base=poll_interval, cap=WATCH_RETRY_MAX)
+            log_success(f"Sync failed, retrying in {delay:.0f}s", step="Watch")
+            return None, time.monotonic() + delay
+        failures = 0
+        if profile.last_run.incomplete_files:
+            log_success(f"Sessions still being written, checking again in {quiet_period}s", step="Watch")
+            return signature, time.monotonic() + quiet_period
+        return signature, None
+
+    try:
+        signature = datalog_signature(flashair)
+    except Exception:
+        signature = None
+    last_synced, retry_at = sync(signature, cleanup=True)
+    last_cleanup = datetime.now().date() if failures == 0 else None
+    last_seen = signature
+    stable_since = time.monotonic()
+    card_reachable = True
+    log_success(f"Watching FlashAir {profile.flashair_ip} every {poll_interval}s (quiet period {quiet_period}s)",
+                step="Watch")
+    while True:
+        flush_logs()  # Don't leave watch messages buffered through a long idle stretch
+        time.sleep(poll_interval)
+        try:
+            # Only re-list while something is pending or the card reports a write
+            idle = last_synced is not None and last_seen == last_synced and retry_at is None
+            if idle and not flashair_was_updated(flashair):
+                continue
+            signature = datalog_signature(flashair)
+            if not card_reachable:
+                log_success("FlashAir is reachable again", step="Watch")
+                card_reachable = True
+        except Exception as e:
+            if card_reachable:
+                log_error(f"FlashAir unreachable, will keep polling: {e}", step="Watch")
+                card_reachable = False
+            continue
+        if signature != last_seen:
+            last_seen = signature
+            stable_since = time.monotonic()
+            continue
+        now = time.monotonic()
+        if retry_at is not None and now < retry_at:
+            continue
+        if (signature != last_synced or retry_at is not None) and now - stable_since >= quiet_period:
+            log_success("DATALOG files are stable, syncing", step="Watch")
+            today = datetime.now().date()
+            last_synced, retry_at = sync(signature, cleanup=today != last_cleanup)
+            if failures == 0:
+                last_cleanup = today
+
+# --- Multi-Profile Orchestration ---
+def run_profiles(profiles, watch_mode=False, poll_interval=WATCH_POLL_INTERVAL, quiet_period=WATCH_QUIET_PERIOD,
+                 max_parallel=None, backfill=False):
+    """Sync several profiles concurrently in this process and return the worst exit code.
+
+    Each card gets one FlashAirClient, whose adaptive limiter caps requests to
+    that card no matter how many profiles point at it. Profiles on the same
+    SleepHQ account share one client (and token), and all SleepHQ clients
+    share one pooled session. In watch mode every profile gets its own watch
+    loop and this never returns.
+    """
+    max_parallel = len(profiles) if watch_mode else min(max_parallel or PROFILE_MAX_PARALLEL, len(profiles))
+    sleephq_session = pooled_session(max_parallel * SLEEPHQ_MAX_WORKERS)
+    flashair_clients, sleephq_clients = {}, {}
+    for profile in profiles:
+        if (profile.flashair_ip, profile.flashair_password) not in flashair_clients:
+            flashair_clients[(profile.flashair_ip, profile.flashair_password)] = profile.flashair_client()
+        if profile.sleephq_account not in sleephq_clients:
+            sleephq_clients[profile.sleephq_account] = profile.sleephq_client(session=sleephq_session)
+
+    def run_profile(profile):
+        flashair = flashair_clients[(profile.flashair_ip, profile.flashair_password)]
+        clients = {"sleephq": sleephq_clients[profile.sleephq_account]}
+        store = profile.dedup_store()
+        try:
+            if watch_mode:
+                watch(flashair, store, poll_interval, quiet_period, profile=profile, clients=clients)
+            if backfill:
+                return run_backfill(flashair, store, clients=clients, profile=profile)
+            return run_sync(flashair, store, clients=clients, profile=profile)
+        except Exception as e:
+            log_error(f"Profile {profile.name} failed: {e}", step="Profiles")
+            return 1
+        finally:
+            store.close()
+
+    log_success(f"Syncing {len(profiles)} profiles, up to {max_parallel} at a time", step="Profiles")
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="profile") as executor:
+            exit_codes = list(executor.map(run_profile, profiles))
+    finally:
+        for flashair in flashair_clients.values():
+            flashair.close()
+        sleephq_session.close()
+    for profile, exit_code in zip(profiles, exit_codes):
+        log_success(f"Profile {profile.name} finished with exit code {exit_code}", step="Profiles")
+    return max(exit_codes, default=0)
+
+# --- Startup ---
+def init_runtime(profiles_file=None):
+    """Check required variables, create LOG_DIR and set up logging; returns False if variables are missing.
+
+    Kept out of import time so the module can be imported (by the benchmark,
+    or just to look at it) without a full environment or touching the logs.
+    """
+    missing_vars = [
+        var for var in REQUIRED_ENV_VARS
+        if not os.getenv(var) and not (profiles_file and var in PROFILE_ENV_VARS)
+    ]
+    if missing_vars:
+        missing_str = ", ".join(missing_vars)
+        sys.stderr.write(f"ERROR: Missing required environment variables: {missing_str}\n")
+        return False
+    os.makedirs(LOG_DIR, exist_ok=True)
+    setup_logging()
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Upload CPAP data from a FlashAir card to SleepHQ and Google Drive.")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and sync whenever new DATALOG files have settled")
+    parser.add_argument("--poll-interval", type=int, default=WATCH_POLL_INTERVAL,
+                        help="seconds between FlashAir polls in watch mode")
+    parser.add_argument("--quiet-period", type=int, default=WATCH_QUIET_PERIOD,
+                        help="seconds DATALOG files must stay unchanged before a watch-mode sync")
+    parser.add_argument("--profiles", metavar="FILE", default=PROFILES_FILE,
+                        help="JSON file of device/account profiles to sync concurrently (default: PROFILES_FILE)")
+    parser.add_argument("--backfill", action="store_true",
+                        help="upload every unsynced DATALOG night older than yesterday, newest first, then exit")
+    parser.add_argument("--retention-dry-run", action="store_true",
+                        help="report what the retention policy would delete (folders, files, bytes) and exit")
+    restore = parser.add_argument_group("nightly archive restore")
+    restore.add_argument("--restore", metavar="SOURCE",
+                         help="list a nightly archive: a Drive date folder (YYYYMMDD) or a local archive file")
+    restore.add_argument("--files", nargs="+", metavar="PATTERN",
+                         help="only these archive paths (shell-style wildcards allowed)")
+    restore.add_argument("--verify", action="store_true", help="check files against the manifest SHA-256s")
+    restore.add_argument("--extract", metavar="DIR", help="extract (and verify) files into DIR")
+    restore.add_argument("--profile", metavar="NAME",
+                         help="profile whose Drive folder holds the archive (needed with several --profiles)")
+    args = parser.parse_args(argv)
+    if args.profile and not args.profiles:
+        parser.error("--profile needs --profiles (or PROFILES_FILE)")
+    if not init_runtime(args.profiles):
+        return 1
+
+    if args.restore:
+        profile = None
+        if args.profiles:
+            profiles = load_profiles(args.profiles)
+            if args.profile:
+                profiles = [profile for profile in profiles if profile.name == args.profile]
+                if not profiles:
+                    parser.error(f"no profile named {args.profile} in {args.profiles}")
+            elif len(profiles) > 1:
+                parser.error("--restore with several profiles needs --profile NAME")
+            profile = profiles[0]
+        return restore_archive(args.restore, args.files, args.verify, args.extract, profile)
+
+    if args.retention_dry_run:
+        for profile in load_profiles(args.profiles) if args.profiles else [Profile()]:
+            flashair = profile.flashair_client()
+            try:
+                run_retention(flashair, profile, {}, dry_run=True)
+            finally:
+                flashair.close()
+        return 0
+
+    if args.profiles:
+        return run_profiles(load_profiles(args.profiles), args.watch, args.poll_interval, args.quiet_period,
+                            backfill=args.backfill)
+
+    profile = Profile()
+    flashair = profile.flashair_client()
+    store = profile.dedup_store()
+    if args.backfill:
+        return run_backfill(flashair, store, profile=profile)
+    if args.watch:
+        watch(flashair, store, args.poll_interval, args.quiet_period, profile=profile)
+        return 0
+    return run_sync(flashair, store, profile=profile)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,469 @@
+"""Offline benchmark for SLEEPHQ_CPAP_UPLOADER_FULL.py.
+
+Starts local stand-ins for the FlashAir card and the SleepHQ API in a child
+process, swaps Google Drive for an in-process fake, and times full runs of
+the uploader's normal sync flow against them. No card or live account needed.
+
+Examples:
+    python benchmark_uploader.py --preset small
+    python benchmark_uploader.py --preset small --cold-start
+    python benchmark_uploader.py --nights 30 --files-per-night 2000 --flashair-latency-ms 40 \\
+        --flashair-bandwidth-kbps 1500 --error-rate 0.02 --runs 2 --json results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PRESETS = {
+    "small": {"nights": 1, "files_per_night": 50},
+    "large": {"nights": 30, "files_per_night": 2000},
+}
+
+# --- Synthetic Dataset ---
+def fat_date(dt):
+    return ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+
+def fat_time(dt):
+    return (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2)
+
+def build_dataset(nights, files_per_night, file_size, empty_files=0):
+    """Return {directory: [(name, size, date, time, is_dir)]} shaped like a ResMed card.
+
+    The last empty_files EDF files of each night hold a header and no data records.
+    """
+    now = datetime.now()
+    tree = defaultdict(list)
+    tree["/"] += [
+        ("DATALOG", 0, fat_date(now), 0, True),
+        ("SETTINGS", 0, fat_date(now), 0, True),
+        ("STR.edf", 64 * 1024, fat_date(now), fat_time(now), False),
+        ("Identification.crc", 2, fat_date(now), fat_time(now), False),
+        ("Identification.json", 1024, fat_date(now), fat_time(now), False),
+    ]
+    for name in ("CurrentSettings.json", "CurrentSettings.crc"):
+        tree["/SETTINGS"].append((name, 4096, fat_date(now), fat_time(now), False))
+    for night in range(nights):
+        day = now - timedelta(days=night)
+        folder = day.strftime("%Y%m%d")
+        tree["/DATALOG"].append((folder, 0, fat_date(day), 0, True))
+        for i in range(files_per_night):
+            stamp = (day.replace(hour=22, minute=0, second=0) + timedelta(seconds=30 * i)).strftime("%Y%m%d_%H%M%S")
+            kind = ("BRP", "PLD", "SAD", "EVE", "CSL")[i % 5]
+            size = EDF_HEADER_BYTES if i >= files_per_night - empty_files else file_size
+            tree[f"/DATALOG/{folder}"].append((f"{stamp}_{kind}.edf", size, fat_date(day), fat_time(day), False))
+    return dict(tree)
+
+EDF_HEADER_BYTES = 512  # One signal
+EDF_SAMPLES = 256  # Per data record, so a record is 512 bytes
+
+def file_bytes(path, size):
+    """Deterministic content; .edf files start with a valid one-signal EDF header."""
+    data = random.Random(path).randbytes(size)
+    if not path.lower().endswith(".edf") or size < EDF_HEADER_BYTES:
+        return data
+    name = path.rsplit("/", 1)[-1]
+    try:
+        start = datetime.strptime(name[:15], "%Y%m%d_%H%M%S")
+    except ValueError:
+        start = datetime(2020, 1, 1)
+    n_records = (size - EDF_HEADER_BYTES) // (2 * EDF_SAMPLES)
+    header = (f"{'0':<8}{'bench':<80}{'bench':<80}{start:%d.%m.%y}{start:%H.%M.%S}{EDF_HEADER_BYTES:<8}{'':<44}"
+              f"{n_records:<8}{'1':<8}{'1':<4}"
+              f"{'Flow':<16}{'':<80}{'L/s':<8}{'-100':<8}{'100':<8}{'-32768':<8}{'32767':<8}{'':<80}"
+              f"{EDF_SAMPLES:<8}{'':<32}").encode()
+    return header + data[EDF_HEADER_BYTES:]
+
+# --- Stub Servers ---
+OUTAGE_AFTER = 10  # File GETs served before a simulated --flashair-outage starts
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = {}
+
+    def log_message(self, *args):
+        pass
+
+    def _delay(self):
+        latency = self.config["latency_ms"] / 1000
+        if latency:
+            time.sleep(latency)
+
+    def _maybe_fail(self):
+        if random.random() < self.config["error_rate"]:
+            self._send(503, b"busy")
+            return True
+        return False
+
+    def _send(self, status, body, content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        bandwidth = self.config.get("bandwidth_kbps")
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        chunk = 16 * 1024
+        for offset in range(0, len(body), chunk):
+            piece = body[offset:offset + chunk]
+            self.wfile.write(piece)
+            time.sleep(len(piece) / (bandwidth * 1024 / 8))
+
+
+class FlashAirStub(StubHandler):
+    """Speaks command.cgi op=100/102/108/111 and serves file GETs from the synthetic dataset."""
+    tree = {}
+    outage = {"served": 0, "down_until": None, "lock": threading.Lock()}
+
+    def _offline(self):
+        """Simulated reboot: after OUTAGE_AFTER file GETs, connections are dropped for outage_s seconds."""
+        if not self.config.get("outage_s"):
+            return False
+        with self.outage["lock"]:
+            now = time.monotonic()
+            if self.outage["down_until"] is None and self.outage["served"] >= OUTAGE_AFTER:
+                self.outage["down_until"] = now + self.config["outage_s"]
+            if self.outage["down_until"] and now < self.outage["down_until"]:
+                self.close_connection = True
+                return True
+            return False
+
+    def do_GET(self):
+        if self._offline():
+            return
+        self._delay()
+        if self._maybe_fail():
+            return
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/command.cgi":
+            query = urllib.parse.parse_qs(url.query)
+            op = query.get("op", [""])[0]
+            if op == "100":
+                directory = query.get("DIR", ["/"])[0]
+                if directory not in self.tree:
+                    return self._send(404, b"")
+                lines = ["WLANSD_FILELIST"] + [
+                    f"{directory},{name},{size},{16 if is_dir else 32},{date},{tm}"
+                    for name, size, date, tm, is_dir in self.tree[directory]
+                ]
+                return self._send(200, "\r\n".join(lines).encode())
+            if op == "102":
+                return self._send(200, b"0")
+            if op == "108":
+                return self._send(200, b"FlashAir stub")
+            if op == "111":
+                return self._send(200, b"SUCCESS")
+            return self._send(400, b"")
+        # The uploader escapes every "/" in the path, so normalise the leading slashes
+        path = "/" + urllib.parse.unquote(url.path).lstrip("/")
+        directory, _, name = path.rpartition("/")
+        for entry in self.tree.get(directory or "/", []):
+            if entry[0] == name and not entry[4]:
+                with self.outage["lock"]:
+                    self.outage["served"] += 1
+                body = file_bytes(path, entry[1])
+                start, end = self._byte_range(len(body))
+                if start is None:
+                    return self._send(200, body, "application/octet-stream")
+                return self._send(206, body[start:end + 1], "application/octet-stream",
+                                  {"Content-Range": f"bytes {start}-{end}/{len(body)}"})
+        self._send(404, b"")
+
+    def _byte_range(self, size):
+        """(start, end) of a single "Range: bytes=a-b" request header, or (None, None)."""
+        spec = self.headers.get("Range", "")
+        if not spec.startswith("bytes=") or "," in spec:
+            return None, None
+        start, _, end = spec[len("bytes="):].partition("-")
+        if not start:
+            return None, None
+        return int(start), min(int(end) if end else size - 1, size - 1)
+
+
+class SleepHQStub(StubHandler):
+    """Answers the OAuth token, imports, files and process_files endpoints.
+
+    Imports it never handed out get a 404, like SleepHQ's answer to an expired import.
+    """
+    next_import = [0]
+
+    def do_POST(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+        self._delay()
+        if self._maybe_fail():
+            return
+        if self.path == "/oauth/token":
+            body = {"access_token": "bench", "refresh_token": "bench-refresh", "expires_in": 7200}
+        elif self.path.endswith("/imports"):
+            self.next_import[0] += 1
+            body = {"data": {"id": str(self.next_import[0])}}
+        elif int(self.path.split("/imports/")[1].split("/")[0]) > self.next_import[0]:
+            return self._send(404, b"")
+        else:
+            body = {"data": {}}
+        self._send(200, json.dumps(body).encode(), "application/json")
+
+
+def serve_stubs(args, ports):
+    FlashAirStub.tree = build_dataset(args.nights, args.files_per_night, args.file_size, args.empty_files_per_night)
+    FlashAirStub.config = {
+        "latency_ms": args.flashair_latency_ms,
+        "bandwidth_kbps": args.flashair_bandwidth_kbps,
+        "error_rate": args.error_rate,
+        "outage_s": args.flashair_outage,
+    }
+    SleepHQStub.config = {"latency_ms": args.sleephq_latency_ms, "error_rate": args.error_rate}
+    # One FlashAir stub per simulated device (same card contents), one shared SleepHQ stub last
+    servers = [ThreadingHTTPServer(("127.0.0.1", 0), FlashAirStub) for _ in range(args.devices)]
+    servers.append(ThreadingHTTPServer(("127.0.0.1", 0), SleepHQStub))
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports.put([server.server_address[1] for server in servers])
+    threading.Event().wait()
+
+# --- Fake Google Drive ---
+class FakeDriveBackend:
+    """Stands in for DriveBackend: simulated latency/bandwidth, no network."""
+    latency_ms = 0
+    bandwidth_kbps = 0
+    error_rate = 0.0
+
+    def __init__(self, *args, **kwargs):
+        self.uploaded = []
+
+    def upload(self, file_path, date_folder, replace=False):
+        time.sleep(self.latency_ms / 1000)
+        if self.bandwidth_kbps:
+            time.sleep(os.path.getsize(file_path) / (self.bandwidth_kbps * 1024 / 8))
+        if random.random() < self.error_rate:
+            return False
+        self.uploaded.append((str(file_path), date_folder))
+        return True
+
+    def list_folders(self):
+        return [(date_folder, date_folder) for date_folder in sorted({folder for _, folder in self.uploaded})]
+
+    def folder_sizes(self, folder_ids):
+        return {folder_id: (0, 0) for folder_id in folder_ids}
+
+    def delete_files(self, file_ids):
+        time.sleep(self.latency_ms / 1000)
+        return {}
+
+    def forget_folder(self, date_folder):
+        pass
+
+# --- Instrumentation ---
+def merge_stages(summaries):
+    """Add up per-stage stats from several profiles' run summaries."""
+    merged = {}
+    for summary in summaries:
+        for stage, stats in summary["stages"].items():
+            total = merged.setdefault(stage, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0,
+                                              "retries": 0, "errors": {}})
+            for field in ("count", "seconds", "bytes", "retries"):
+                total[field] += stats[field]
+            total["seconds"] = round(total["seconds"], 3)
+            total["max_seconds"] = max(total["max_seconds"], stats["max_seconds"])
+            for error, count in stats["errors"].items():
+                total["errors"][error] = total["errors"].get(error, 0) + count
+    return dict(sorted(merged.items()))
+
+def peak_rss_mb():
+    # VmHWM starts afresh in an exec'd child, ru_maxrss keeps the parent's peak from before the exec
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# --- Runner ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the uploader against local stand-in services.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), help="dataset size shortcut")
+    parser.add_argument("--nights", type=int, default=2, help="DATALOG date folders on the card")
+    parser.add_argument("--files-per-night", type=int, default=50, help="EDF files per DATALOG folder")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="bytes per EDF file")
+    parser.add_argument("--empty-files-per-night", type=int, default=0,
+                        help="EDF files per night with a header but no data records")
+    parser.add_argument("--flashair-latency-ms", type=float, default=20)
+    parser.add_argument("--flashair-bandwidth-kbps", type=float, default=0, help="0 means unlimited")
+    parser.add_argument("--flashair-outage", type=float, default=0, metavar="SECONDS",
+                        help=f"card drops every connection for this long after serving {OUTAGE_AFTER} files")
+    parser.add_argument("--sleephq-latency-ms", type=float, default=50)
+    parser.add_argument("--drive-latency-ms", type=float, default=80)
+    parser.add_argument("--drive-bandwidth-kbps", type=float, default=0, help="0 means unlimited")
+    parser.add_argument("--drive-backup-mode", choices=["files", "archive"], default="files",
+                        help="one Drive upload per file, or one packed archive per night")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub requests answered with 503")
+    parser.add_argument("--devices", type=int, default=1,
+                        help="simulated FlashAir cards, each synced as its own profile in one process")
+    parser.add_argument("--backfill", action="store_true",
+                        help="time the backfill mode (every night older than yesterday) instead of a normal sync")
+    parser.add_argument("--runs", type=int, default=2, help="first run is cold, later runs reuse sync state")
+    parser.add_argument("--cold-start", action="store_true",
+                        help="afterwards, time a no-op run (import included) in a fresh interpreter")
+    parser.add_argument("--json", metavar="PATH", help="also write results as JSON")
+    args = parser.parse_args(argv)
+    if args.preset:
+        for key, value in PRESETS[args.preset].items():
+            setattr(args, key, value)
+    return args
+
+def load_uploader(flashair_port, workdir, drive_backup_mode="files"):
+    """Import the uploader with its environment pointed at the stubs and a scratch directory."""
+    os.environ.update({
+        "FLASHAIR_IP": f"127.0.0.1:{flashair_port}",
+        "FLASHAIR_PASSWORD": "",
+        "DOWNLOAD_DIR": os.path.join(workdir, "downloads"),
+        "LOG_DIR": os.path.join(workdir, "logs"),
+        "CLIENT_ID": "bench",
+        "CLIENT_SECRET": "bench",
+        "USERNAME": "bench",
+        "PASSWORD": "bench",
+        "TEAM_ID": "1",
+        "CREDENTIALS_JSON": os.path.join(workdir, "credentials.json"),
+        "DRIVE_FOLDER_ID": "bench",
+        "GMAIL_USERNAME": "bench@example.invalid",
+        "GMAIL_APP_PASSWORD": "bench",
+        "NOTIFICATION_EMAIL": "bench@example.invalid",
+        "DRIVE_BACKUP_MODE": drive_backup_mode,
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import SLEEPHQ_CPAP_UPLOADER_FULL as uploader
+    uploader.init_runtime()
+    return uploader
+
+# --- Cold Start ---
+HEAVY_MODULES = ["pydrive2", "googleapiclient", "httplib2", "smtplib"]
+
+def measure_cold_start(sleephq_port, results):
+    """In a fresh interpreter: time the import and one main() run, and note which heavy modules got loaded.
+
+    Runs after the benchmark runs, so the card holds nothing new and main()
+    takes the common no-op path. Email is disabled so nothing leaves the host.
+    """
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    import SLEEPHQ_CPAP_UPLOADER_FULL as uploader
+    imported = time.perf_counter()
+    uploader.BASE_API_URL = f"http://127.0.0.1:{sleephq_port}/api/v1"
+    uploader.OAUTH_TOKEN_URL = f"http://127.0.0.1:{sleephq_port}/oauth/token"
+    uploader.send_email_notification = lambda *args, **kwargs: None
+    exit_code = uploader.main([])
+    finished = time.perf_counter()
+    results.put({
+        "exit_code": exit_code,
+        "import_s": round(imported - start, 3),
+        "run_s": round(finished - imported, 3),
+        "total_s": round(finished - start, 3),
+        "interpreter_rss_mb": round(rss_before, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "heavy_modules_loaded": [name for name in HEAVY_MODULES if name in sys.modules],
+    })
+
+def main(argv=None):
+    args = parse_args(argv)
+    ports = multiprocessing.Queue()
+    stubs = multiprocessing.Process(target=serve_stubs, args=(args, ports), daemon=True)
+    stubs.start()
+    *flashair_ports, sleephq_port = ports.get(timeout=30)
+
+    workdir = tempfile.mkdtemp(prefix="uploader-bench-")
+    uploader = load_uploader(flashair_ports[0], workdir, args.drive_backup_mode)
+    uploader.BASE_API_URL = f"http://127.0.0.1:{sleephq_port}/api/v1"
+    uploader.OAUTH_TOKEN_URL = f"http://127.0.0.1:{sleephq_port}/oauth/token"
+    FakeDriveBackend.latency_ms = args.drive_latency_ms
+    FakeDriveBackend.bandwidth_kbps = args.drive_bandwidth_kbps
+    FakeDriveBackend.error_rate = args.error_rate
+    uploader.DriveBackend = FakeDriveBackend
+    uploader.send_email_notification = lambda *args, **kwargs: None
+
+    if args.devices == 1:
+        profiles = [uploader.Profile()]
+        flashair = profiles[0].flashair_client()
+        store = profiles[0].dedup_store()
+    else:
+        profiles = [
+            uploader.Profile(f"device{i}", os.path.join(workdir, "logs", "profiles", f"device{i}"),
+                             flashair_ip=f"127.0.0.1:{port}",
+                             download_dir=os.path.join(workdir, "downloads", f"device{i}"))
+            for i, port in enumerate(flashair_ports)
+        ]
+    results = {"config": vars(args), "runs": []}
+    for run in range(args.runs):
+        start = time.perf_counter()
+        if args.devices > 1:
+            exit_code = uploader.run_profiles(profiles, backfill=args.backfill)
+        elif args.backfill:
+            exit_code = uploader.run_backfill(flashair, store, profile=profiles[0])
+        else:
+            exit_code = uploader.run_sync(flashair, store, profile=profiles[0])
+        wall = time.perf_counter() - start
+        # Each profile's last_run holds the stage breakdown of this run only
+        stages = merge_stages([profile.last_run.metrics.summary(exit_code) for profile in profiles])
+        downloaded = stages.get("flashair_download", {})
+        files = downloaded.get("count", 0)
+        mbytes = downloaded.get("bytes", 0) / 1e6
+        results["runs"].append({
+            "run": run + 1,
+            "kind": "cold" if run == 0 else "warm",
+            "exit_code": exit_code,
+            "wall_s": round(wall, 3),
+            "files_downloaded": files,
+            "files_per_s": round(files / wall, 2) if wall else 0,
+            "mb_per_s": round(mbytes / wall, 2) if wall else 0,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "stages": stages,
+        })
+    if args.devices == 1:
+        flashair.close()
+    if args.cold_start:
+        # A spawned child starts from a bare interpreter and inherits the stub environment
+        context = multiprocessing.get_context("spawn")
+        cold = context.Queue()
+        child = context.Process(target=measure_cold_start, args=(sleephq_port, cold))
+        child.start()
+        results["cold_start"] = cold.get(timeout=300)
+        child.join()
+    stubs.terminate()
+
+    for run in results["runs"]:
+        print(f"\nRun {run['run']} ({run['kind']}): exit={run['exit_code']} wall={run['wall_s']}s "
+              f"files/s={run['files_per_s']} MB/s={run['mb_per_s']} peak RSS={run['peak_rss_mb']} MB")
+        print(f"  {'stage':<22}{'calls':>8}{'busy s':>10}{'max s':>8}{'MB':>10}{'retries':>9}{'errors':>8}")
+        for stage, stats in run["stages"].items():
+            print(f"  {stage:<22}{stats['count']:>8}{stats['seconds']:>10}{stats['max_seconds']:>8}"
+                  f"{stats['bytes'] / 1e6:>10.2f}{stats['retries']:>9}{sum(stats['errors'].values()):>8}")
+    if "cold_start" in results:
+        cold = results["cold_start"]
+        print(f"\nCold start (no-op run): exit={cold['exit_code']} import={cold['import_s']}s run={cold['run_s']}s "
+              f"total={cold['total_s']}s peak RSS={cold['peak_rss_mb']} MB "
+              f"(bare interpreter {cold['interpreter_rss_mb']} MB)")
+        print(f"  heavy modules loaded: {', '.join(cold['heavy_modules_loaded']) or 'none'}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())